@@ -0,0 +1,73 @@
+"""
+Compares blob size and encode/decode time of persistence codecs.
+
+The data imitates the objects the bot writes with the sharded S3Persistence layout:
+a conversations bucket of a handler and a single user_data entry.
+msgpack and zstd are measured only if installed.
+
+Usage (from the project root):
+    python -m benchmarks.persistence_codec
+"""
+import time
+
+from src.service import persistence_codec
+from src.service.persistence_codec import PersistenceCodec
+
+USER_COUNT = 10000
+BUCKETS = 16
+REPEATS = 5
+# Calls per measurement, a single entry is encoded in microseconds
+NUMBER = 1000
+
+
+def make_data():
+    return {
+        'conversations': {(user_id, user_id): 1 for user_id in range(0, USER_COUNT, BUCKETS)},
+        'user_data': {'name': 'User 1', 'phone': '+70000000000'},
+    }
+
+
+def get_codecs():
+    serializers = ['pickle', 'json']
+    compressions = [None, 'zlib']
+
+    if persistence_codec.msgpack is not None:
+        serializers.append('msgpack')
+
+    if persistence_codec.zstandard is not None:
+        compressions.append('zstd')
+
+    return [
+        PersistenceCodec(serializer=serializer, compression=compression)
+        for serializer in serializers
+        for compression in compressions
+    ]
+
+
+def measure(function, *args):
+    best = None
+
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in range(NUMBER):
+            function(*args)
+        elapsed = (time.perf_counter() - start) / NUMBER
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000000
+
+
+def main():
+    print(f"{'data':<14} {'codec':<16} {'size, B':>10} {'encode, us':>11} {'decode, us':>11}")
+
+    for name, data in make_data().items():
+        for codec in get_codecs():
+            blob = codec.encode(data)
+            title = f"{codec.serializer}+{codec.compression or 'none'}"
+
+            print(f"{name:<14} {title:<16} {len(blob):>10} "
+                  f"{measure(codec.encode, data):>11.1f} {measure(codec.decode, blob):>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures S3Persistence startup time depending on the number of stored users.
+
+Startup means the reads made by Application.initialize: user_data, chat_data, bot_data
+and conversations, followed by the first access of a single user.
+The S3 client is replaced with an in-memory stub, so only CPU time is measured.
+
+Usage (from the project root):
+    python -m benchmarks.persistence_startup
+"""
+import asyncio
+import io
+import pickle
+import time
+from copy import deepcopy
+
+from src.service.s3_persistence import S3Persistence
+
+USER_COUNTS = [100, 1000, 10000, 50000]
+REPEATS = 5
+
+
+class StubS3:
+    """
+    In-memory S3 client stub.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+def make_blob(user_count):
+    user_data = {
+        user_id: {'name': f'User {user_id}', 'phone': '+70000000000', 'files': [f'file_{user_id}.mp3']}
+        for user_id in range(user_count)
+    }
+
+    return pickle.dumps({
+        'user_data': user_data,
+        'chat_data': deepcopy(user_data),
+        'bot_data': {},
+        'callback_data': None,
+        'conversations': {'upload': {(user_id, user_id): None for user_id in range(user_count)}},
+    })
+
+
+async def startup(blob, copy_all):
+    persistence = S3Persistence(filepath='persistence')
+    persistence.s3 = StubS3({'persistence': blob})
+
+    user_data = await persistence.get_user_data()
+    chat_data = await persistence.get_chat_data()
+    await persistence.get_bot_data()
+    await persistence.get_conversations('upload')
+
+    if copy_all:
+        # Previous behaviour: every read returned a deep copy of the whole dict
+        deepcopy(user_data)
+        deepcopy(chat_data)
+
+    await persistence.refresh_user_data(0, user_data[0])
+    await persistence.refresh_chat_data(0, chat_data[0])
+
+
+def measure(blob, copy_all):
+    best = None
+
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        asyncio.run(startup(blob, copy_all))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000
+
+
+def main():
+    print(f"{'users':>8} {'deepcopy, ms':>14} {'lazy copy, ms':>14}")
+
+    for user_count in USER_COUNTS:
+        blob = make_blob(user_count)
+        print(f"{user_count:>8} {measure(blob, True):>14.1f} {measure(blob, False):>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
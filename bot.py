@@ -1,14 +1,30 @@
 import asyncio
+import base64
+import binascii
+import hmac
 import json
 import os
+import tempfile
 from pathlib import Path
+from typing import Dict, List, Optional, Set
 
-from telegram import BotCommand, Update
-from telegram.ext import (ApplicationBuilder, Application, PicklePersistence)
+import ydb
+from telegram import Bot, BotCommand, Update
+from telegram.ext import (ApplicationBuilder, Application, ConversationHandler, PicklePersistence)
+from src.service import conversation_states
+from src.service.analysis_result import complete_analysis
+from src.service.persistence_codec import PersistenceCodec
 from src.service.s3_persistence import S3Persistence
+from src.service.ydb_persistence import YdbPersistence
 
 from src import bootstrap
 
+# Warm container state. Cloud Function instances are reused between invocations,
+# so the application and the event loop it is bound to are created only once.
+_application: Optional[Application] = None
+_bot: Optional[Bot] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
 
 async def set_commands(application: Application):
     """
@@ -26,15 +42,56 @@ async def set_commands(application: Application):
     )
 
 
-def cloud_handler(event, context):
-    return asyncio.run(cloud_run(event, context))
+def create_persistence():
+    """
+    Creates the persistence configured by PERSISTENCE environment variable: 's3' (default) or 'ydb'.
+    Data is saved once per invocation in save_persistence().
+    """
+    # JSON keeps the stored data readable after Python and python-telegram-bot upgrades,
+    # data it can not represent is stored with pickle. The pickle data of earlier versions is read by the codec too,
+    # this is how the single persistence object is migrated to the sharded layout on first start
+    codec = PersistenceCodec(serializer='json', compression='zlib')
 
+    if os.getenv('PERSISTENCE') == 'ydb':
+        return YdbPersistence({
+            'endpoint': os.getenv('YDB_ENDPOINT'),
+            'database': os.getenv('YDB_DATABASE'),
+            'credentials': ydb.iam.MetadataUrlCredentials(),
+        }, update_interval=1, on_flush=True, codec=codec)
+
+    return S3Persistence(filepath=Path('persistence'), update_interval=1, on_flush=True, sharded=True,
+                         cache_dir=Path(tempfile.gettempdir()) / 'persistence', conditional_writes=True,
+                         codec=codec)
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop of the current container.
+    The application http client is bound to this loop, so it must outlive a single invocation.
+    """
+    global _loop
+
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+
+    return _loop
+
+
+async def get_application() -> Application:
+    """
+    Returns the initialized application of the current container.
+    On cold start it loads services, registers handlers, restores persistence and sets bot commands.
+    """
+    global _application
+
+    if _application is not None:
+        return _application
 
-async def cloud_run(event, context):
     bootstrap.load()
     from src.hanlders import all_handlers
 
-    persistence = S3Persistence(filepath=Path('persistence'), update_interval=1)
+    persistence = create_persistence()
 
     application = ApplicationBuilder().token(os.getenv('TOKEN')).persistence(persistence).build()
 
@@ -42,12 +99,219 @@ async def cloud_run(event, context):
         application.add_handler(handler)
 
     await application.initialize()
-    await set_commands(application)
 
-    async with application:
-        await application.process_update(
-            Update.de_json(json.loads(event["body"]), application.bot)
-        )
+    if os.getenv('SET_COMMANDS', '1') == '1':
+        await set_commands(application)
+
+    _application = application
+
+    return _application
+
+
+async def get_bot() -> Bot:
+    """
+    Returns the initialized bot of the current container.
+    The result callback only sends messages, so the application with its persistence is not loaded for it.
+    """
+    global _bot
+
+    if _application is not None:
+        return _application.bot
+
+    if _bot is None:
+        bootstrap.load()
+
+        bot = Bot(os.getenv('TOKEN'))
+        await bot.initialize()
+
+        _bot = bot
+
+    return _bot
+
+
+def extract_updates(event) -> List[dict]:
+    """
+    Extracts raw updates from the function event.
+    Supports a webhook request with a single update or a JSON array of updates in the body,
+    and a message queue trigger event with a batch of messages, each containing one or more updates.
+    """
+    if 'messages' in event:
+        bodies = [message['details']['message']['body'] for message in event['messages']]
+    else:
+        bodies = [event['body']]
+
+    updates = []
+
+    for body in bodies:
+        data = json.loads(body)
+
+        if isinstance(data, list):
+            updates.extend(data)
+        else:
+            updates.append(data)
+
+    return updates
+
+
+def get_update_key(update: Update):
+    """
+    Returns the key which updates are ordered by: chat, then user, then the update itself.
+    """
+    if update.effective_chat is not None:
+        return 'chat', update.effective_chat.id
+
+    if update.effective_user is not None:
+        return 'user', update.effective_user.id
+
+    return 'update', update.update_id
+
+
+def get_conversation_handlers(application: Application) -> List[ConversationHandler]:
+    """
+    Returns the persistent conversation handlers of the application.
+    """
+    return [
+        handler
+        for handlers in application.handlers.values()
+        for handler in handlers
+        if isinstance(handler, ConversationHandler) and handler.persistent
+    ]
+
+
+async def refresh_application(application: Application, updates: List[Update]):
+    """
+    Reloads the persisted data of a reused application before processing the updates.
+    Other container instances may have changed it since the previous invocation.
+    Conversation handlers read the states from the persistence only on initialize, so the reloaded
+    states of the updates are passed to them, see conversation_states.
+    """
+    handlers = get_conversation_handlers(application)
+
+    conversation_keys: Dict[str, Set[tuple]] = {}
+
+    for handler in handlers:
+        keys = conversation_keys.setdefault(handler.name, set())
+
+        for update in updates:
+            key = conversation_states.get_key(handler, update)
+
+            if key is not None:
+                keys.add(key)
+
+    await application.persistence.reload(conversation_keys)
+
+    for handler in handlers:
+        stored = await application.persistence.get_conversations(handler.name)
+
+        for key in conversation_keys[handler.name]:
+            conversation_states.set_state(handler, key, stored.get(key))
+
+
+async def process_updates(application: Application, updates: List[Update]):
+    """
+    Processes updates concurrently across chats.
+    Updates of the same chat are processed sequentially in the order they were received.
+    If a queue fails, its error is raised after the other queues are finished.
+    """
+    queues = {}
+
+    for update in updates:
+        queues.setdefault(get_update_key(update), []).append(update)
+
+    async def process_queue(queue):
+        for queued_update in queue:
+            await application.process_update(queued_update)
+
+    # A failed queue does not stop the others, so the data is saved only after all of them are finished
+    results = await asyncio.gather(*(process_queue(queue) for queue in queues.values()), return_exceptions=True)
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+
+    for error in errors[1:]:
+        print(f"Error: '{error!r}' occurred")
+
+    if errors:
+        raise errors[0]
+
+
+async def save_persistence(application: Application):
+    """
+    Passes the changed data to the persistence and uploads it once.
+    The application is not shut down between invocations, so this is done explicitly.
+    """
+    await application.update_persistence()
+    await application.persistence.flush()
+
+
+def cloud_handler(event, context):
+    return get_event_loop().run_until_complete(cloud_run(event, context))
+
+
+async def cloud_run(event, context):
+    application = await get_application()
+
+    updates = [Update.de_json(data, application.bot) for data in extract_updates(event)]
+
+    await refresh_application(application, updates)
+
+    try:
+        await process_updates(application, updates)
+    finally:
+        await save_persistence(application)
+
+    return {
+        'statusCode': 200,
+        'body': 'Success'
+    }
+
+
+def get_callback_file_id(event):
+    """
+    Returns file_id from the callback request body or None if the body is malformed.
+    """
+    body = event.get('body') or ''
+
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+
+        data = json.loads(body)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+    if not isinstance(data, dict) or not isinstance(data.get('file_id'), str):
+        return None
+
+    return data['file_id']
+
+
+def result_handler(event, context):
+    """
+    Analysis result callback, called by the analysis service when a file is processed.
+    """
+    return get_event_loop().run_until_complete(result_run(event, context))
+
+
+async def result_run(event, context):
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+
+    token = os.getenv('CALLBACK_TOKEN')
+
+    if not token or not hmac.compare_digest(headers.get('x-callback-token', '').encode(), token.encode()):
+        return {
+            'statusCode': 401,
+            'body': 'Unauthorized'
+        }
+
+    file_id = get_callback_file_id(event)
+
+    if not file_id:
+        return {
+            'statusCode': 400,
+            'body': 'file_id is required'
+        }
+
+    await complete_analysis(await get_bot(), file_id)
 
     return {
         'statusCode': 200,
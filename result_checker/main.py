@@ -1,118 +1,216 @@
 import asyncio
 import os
-from time import sleep
+import random
+import time
 
-import requests
-import ydb
-from dotenv import load_dotenv
+from telegram import Bot
+from telegram.error import TelegramError
 
+from src import bootstrap
+from src.constants import Stage
+from src.repository.request_repository import RequestRepository
+from src.repository.user_repository import UserRepository
+from src.service.analysis_result import notify_analysis_done
+from src.service.rest_client import CircuitOpenError, RestClient, RestClientError
+from src.service_locator import ServiceLocator
 
-def cloud_handler(event, context):
-    return asyncio.run(cloud_run(event, context))
+# Maximum number of concurrent requests to the analysis API
+CONCURRENCY = int(os.getenv('CHECK_CONCURRENCY', 16))
 
+# Maximum number of requests checked per run and seconds after which no new checks are started
+BUDGET = int(os.getenv('CHECK_BUDGET', 500))
+TIME_BUDGET = float(os.getenv('CHECK_TIME_BUDGET', 50))
 
-async def cloud_run(event, context):
-    load_dotenv()
+# Initial and maximum rate of requests to the analysis API, per second
+RATE = float(os.getenv('CHECK_RATE', 10))
+MAX_RATE = float(os.getenv('CHECK_MAX_RATE', 50))
+
+# Delay before the next check grows exponentially from the first to the maximum one, in seconds
+# The analysis service reports results to the callback, so the checker only picks up missed ones
+FIRST_DELAY = int(os.getenv('CHECK_FIRST_DELAY', 600))
+MAX_DELAY = int(os.getenv('CHECK_MAX_DELAY', 1800))
+
+# Seconds the checked requests are leased to the checker, other checkers skip them meanwhile
+LEASE = int(os.getenv('CHECK_LEASE', 120))
+
+# Seconds after upload the analysis is considered failed
+MAX_AGE = int(os.getenv('CHECK_MAX_AGE', 24 * 3600))
+
+# Event loop of the container. The rest client connections are bound to it,
+# so they are kept alive between invocations
+_loop = None
+
+
+class RateLimiter:
+    """
+    Adaptive rate limiter.
+    The rate grows additively while the API answers and is halved when it is throttled or fails,
+    a Retry-After pause is respected.
+    """
+
+    def __init__(self, rate, max_rate, min_rate=1.0):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.next_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Waits for the next request slot.
+        """
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(self.next_at, now) + 1 / self.rate
 
-    driver_config = ydb.DriverConfig(endpoint=os.getenv('YDB_ENDPOINT'), database=os.getenv('YDB_DATABASE'),
-                                     credentials=ydb.iam.MetadataUrlCredentials())
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-    driver = ydb.Driver(driver_config)
+    def success(self):
+        self.rate = min(self.max_rate, self.rate + 1)
+
+    def throttled(self, retry_after=None):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+        if retry_after:
+            self.next_at = max(self.next_at, time.monotonic() + retry_after)
+
+
+def get_event_loop():
+    global _loop
+
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+
+    return _loop
+
+
+async def check(rest_client, limiter, request):
+    """
+    Checks the analysis result of the request.
+    Returns True if the result is ready, False if not and None if the check failed.
+    Raises CircuitOpenError if the analysis API is considered unavailable.
+    """
+    await limiter.acquire()
 
     try:
-        driver.wait(timeout=5)
-    except:
-        return
+        ready = await rest_client.get_result(request['operation_id'])
+    except CircuitOpenError:
+        raise
+    except RestClientError as e:
+        print(f"Error: '{e}' occurred")
+        limiter.throttled(e.retry_after)
+        return None
+
+    limiter.success()
+
+    return ready
 
-    session = driver.table_client.session().create()
 
-    db_requests = session.transaction().execute('SELECT * FROM requests WHERE stage == "P"',
-                                                commit_tx=True)
+def get_next_check_at(now, attempt):
+    """
+    Returns the time of the next check: exponential backoff with jitter,
+    so the checks of requests uploaded together spread over time.
+    """
+    delay = min(MAX_DELAY, FIRST_DELAY * 2 ** attempt)
 
-    analysis_requests = db_requests[0].rows
+    return now + int(random.uniform(delay / 2, delay))
 
-    if analysis_requests is None or len(analysis_requests) == 0:
+
+def cloud_handler(event, context):
+    return get_event_loop().run_until_complete(cloud_run(event, context))
+
+
+async def cloud_run(event, context):
+    bootstrap.load()
+
+    started_at = time.monotonic()
+
+    locator = ServiceLocator()
+
+    request_repository: RequestRepository = locator.get('request_repository')
+    user_repository: UserRepository = locator.get('user_repository')
+    rest_client: RestClient = locator.get('rest_client')
+
+    now = int(time.time())
+
+    analysis_requests = request_repository.lease_due(now, BUDGET, LEASE)
+
+    if len(analysis_requests) == 0:
         return {
             'statusCode': 200,
             'body': 'Success'
         }
 
-    for i, row in enumerate(analysis_requests):
-        for k, v in row.items():
-            if isinstance(v, (bytes, bytearray)):
-                analysis_requests[i][k] = v.decode('utf8')
+    limiter = RateLimiter(RATE, MAX_RATE)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    # Set when the circuit of the analysis API opens, the requests left are checked after their lease expires
+    unavailable = asyncio.Event()
 
-    analysis_requests = sorted(analysis_requests[0:5], key=lambda el: el['created_at'])
+    updates = []
+    finished = []
 
-    for request in analysis_requests:
-        request_id = request['id']
-        user_id = request['user_id']
+    async def process(request):
         attempt = request.get("attempt") if request.get("attempt") else 0
 
-        if attempt >= 5:
-            session.transaction().execute(f'UPDATE requests SET stage = "F" WHERE id == "{request_id}"',
-                                          commit_tx=True)
-            continue
+        if request['created_at'] is not None and now - request['created_at'] > MAX_AGE:
+            updates.append({'id': request['id'], 'stage': Stage.FAILED.value, 'attempt': attempt,
+                            'next_check_at': None})
+            return
+
+        async with semaphore:
+            if unavailable.is_set() or time.monotonic() - started_at > TIME_BUDGET:
+                return
+
+            try:
+                ready = await check(rest_client, limiter, request)
+            except CircuitOpenError as e:
+                if not unavailable.is_set():
+                    print(f"Error: '{e}' occurred, checks are stopped")
+                    unavailable.set()
+                return
+
+        if ready is None:
+            return
+
+        if ready:
+            updates.append({'id': request['id'], 'stage': Stage.SUCCESS.value, 'attempt': attempt + 1,
+                            'next_check_at': None})
+            finished.append(request)
+        else:
+            updates.append({'id': request['id'], 'stage': Stage.PROCESS.value, 'attempt': attempt + 1,
+                            'next_check_at': get_next_check_at(now, attempt)})
 
-        url = os.getenv('API_URL') + 'result/'
+    await asyncio.gather(*[process(request) for request in analysis_requests])
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + os.getenv('API_TOKEN')
-        }
+    # Requests completed meanwhile by the result callback are skipped, so users are notified once
+    updated = request_repository.update_processing(updates)
 
-        data = {
-            "file_id": request['operation_id'],
-        }
+    finished = [request for request in finished if request['id'] in updated]
 
-        response = requests.post(url, headers=headers, json=data)
-
-        if response.status_code == 200:
-            session.transaction().execute(
-                f'UPDATE requests SET stage = "S", attempt = {attempt + 1} WHERE id == "{request_id}"',
-                commit_tx=True)
-
-            db_user = session.transaction().execute(f'SELECT * FROM users WHERE id == "{user_id}"',
-                                                    commit_tx=True)
-
-            users = db_user[0].rows
-
-            if users is None or len(users) == 0:
-                continue
-
-            user = users[0]
-
-            for k, v in user.items():
-                if isinstance(v, (bytes, bytearray)):
-                    user[k] = v.decode('utf8')
-
-            url = ''
-            result_url = ''
-
-            requests.post(
-                url=url,
-                data={
-                    'chat_id': user['chat_id'],
-                    'text': f"Анализ файла {request['file_name']} завершён.",
-                    'reply_markup': {
-                        'inline_keyboard': [[
-                            {
-                                'text': 'Просмотреть',
-                                'web_app': {
-                                    'url': f"{result_url}?file_id=" + request['operation_id']
-                                }
-                            },
-                        ]]
-                    }
-                }
-            )
-        else:
-            session.transaction().execute(f'UPDATE requests SET attempt = {attempt + 1} WHERE id == "{request_id}"',
-                                          commit_tx=True)
+    if finished:
+        users = {user['id']: user for user in user_repository.get_by_ids({request['user_id'] for request in finished})}
 
-        sleep(1)
+        async with Bot(os.getenv('TOKEN')) as bot:
+            await asyncio.gather(*[
+                notify(bot, users[request['user_id']], request)
+                for request in finished if request['user_id'] in users
+            ])
 
     return {
         'statusCode': 200,
         'body': 'Success'
     }
+
+
+async def notify(bot, user, request):
+    """
+    Notifies the user that the analysis is finished.
+    """
+    try:
+        await notify_analysis_done(bot, user['chat_id'], request)
+    except TelegramError as e:
+        print(f"Error: '{e}' occurred")
@@ -5,6 +5,7 @@ import ydb
 from dotenv import load_dotenv
 
 from .database.yandex_database import YandexDatabase
+from .repository.file_repository import FileRepository
 from .repository.request_repository import RequestRepository
 from .repository.user_repository import UserRepository
 from .service.s3_storage import S3Storage
@@ -30,7 +31,11 @@ def load():
                 'endpoint': os.getenv('YDB_ENDPOINT'),
                 'database': os.getenv('YDB_DATABASE'),
                 'credentials': ydb.iam.MetadataUrlCredentials(),
-            }, 'users')]
+            }, 'users')],
+            'cache': {
+                'ttl': int(os.getenv('USER_CACHE_TTL', 60)),
+                'max_size': 1024,
+            }
         },
         'request_repository': {
             'className': RequestRepository,
@@ -38,7 +43,15 @@ def load():
                 'endpoint': os.getenv('YDB_ENDPOINT'),
                 'database': os.getenv('YDB_DATABASE'),
                 'credentials': ydb.iam.MetadataUrlCredentials(),
-            }, 'requests')]
+            }, 'requests'), int(os.getenv('CHECK_FIRST_DELAY', 600))]
+        },
+        'file_repository': {
+            'className': FileRepository,
+            'constructorParams': [YandexDatabase({
+                'endpoint': os.getenv('YDB_ENDPOINT'),
+                'database': os.getenv('YDB_DATABASE'),
+                'credentials': ydb.iam.MetadataUrlCredentials(),
+            }, 'files')]
         },
         'file_storage': {
             'className': S3Storage,
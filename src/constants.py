@@ -21,6 +21,7 @@ class State(Enum):
     RECOMMENDATION = 'recommendation'
     TRANSCRIPTION = 'transcription'
     BACK_TO_LIST = 'back_to_list'
+    NEXT_PAGE = 'next_page'
 
 
 class Emoji(Enum):
@@ -11,10 +11,30 @@ class Database(ABC):
     def update(self, entity_id, entity):
         pass
 
+    @abstractmethod
+    def update_if(self, entity_id, condition, entity):
+        pass
+
     @abstractmethod
     def delete(self, entity_id):
         pass
 
+    @abstractmethod
+    def add_many(self, entities):
+        pass
+
+    @abstractmethod
+    def upsert_many(self, entities):
+        pass
+
+    @abstractmethod
+    def update_many(self, entities):
+        pass
+
+    @abstractmethod
+    def update_many_if(self, entities, condition):
+        pass
+
     @abstractmethod
     def get_one(self, select, filter):
         pass
@@ -22,3 +42,15 @@ class Database(ABC):
     @abstractmethod
     def get_list(self, select, filter):
         pass
+
+    @abstractmethod
+    def get_page(self, select, filter, order, limit, cursor=None):
+        pass
+
+    @abstractmethod
+    def lease_until(self, select, filter, column, value, limit, lease):
+        pass
+
+    @abstractmethod
+    def count(self, filter):
+        pass
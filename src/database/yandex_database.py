@@ -1,14 +1,97 @@
+import calendar
 import datetime
 
 import ydb
 
 from .database import Database
 
+# Columns of the tables, see YandexDatabase.create_tables
+TABLES = {
+    'users': '''
+            id String NOT NULL,
+            account_id Uint64,
+            chat_id Uint64,
+            name String,
+            phone String,
+            created_at Datetime,
+            PRIMARY KEY (id)''',
+    'requests': '''
+            id String NOT NULL,
+            stage String,
+            user_id String,
+            operation_id String,
+            file_name String,
+            attempt Uint64,
+            created_at Datetime,
+            next_check_at Datetime,
+            PRIMARY KEY (id)''',
+    'files': '''
+            id String NOT NULL,
+            operation_id String,
+            file_name String,
+            created_at Datetime,
+            PRIMARY KEY (id)''',
+    'persistence': '''
+            kind Utf8 NOT NULL,
+            name Utf8 NOT NULL,
+            entry_key Utf8 NOT NULL,
+            data String,
+            PRIMARY KEY (kind, name, entry_key)''',
+}
+
+# Global secondary indexes of the tables: {table: {index: [columns]}}
+# Lookups by the leading index column read the index table instead of scanning the whole table
+INDEXES = {
+    'users': {
+        'idx_account_id': ['account_id'],
+    },
+    'requests': {
+        'idx_user_id_created_at': ['user_id', 'created_at'],
+        'idx_stage_next_check_at': ['stage', 'next_check_at'],
+        'idx_operation_id': ['operation_id'],
+    },
+}
+
+# Session pools shared by all tables of a database, by (endpoint, database)
+_session_pools = {}
+
+
+def get_session_pool(connection_params):
+    """
+    Returns the session pool of the database.
+    The driver and the pool are created once and shared by all tables, sessions are reused
+    and recreated by the pool after BadSession and other retryable errors.
+    If the database can not be connected, ConnectionError is raised and the next call connects again.
+    :param connection_params: Connection parameters dictionary: {endpoint=, database=, credentials=}
+    """
+    key = (connection_params['endpoint'], connection_params['database'])
+
+    if key in _session_pools:
+        return _session_pools[key]
+
+    driver_config = ydb.DriverConfig(**connection_params)
+
+    driver = ydb.Driver(driver_config)
+
+    try:
+        driver.wait(timeout=5)
+        print('Successfully connected to YDB')
+    except Exception as e:
+        details = driver.discovery_debug_details()
+        driver.stop()
+        raise ConnectionError(f"Connect failed to YDB {key[0]}{key[1]}: {details}") from e
+
+    _session_pools[key] = ydb.SessionPool(driver)
+
+    return _session_pools[key]
+
 
 class YandexDatabase(Database):
     """
     MySQL database class.
     """
+    # Maximum number of rows written by a single query
+    BATCH_SIZE = 1000
 
     def __init__(self, connection_params, table_name):
         """
@@ -16,21 +99,13 @@ class YandexDatabase(Database):
         :param connection_params: Connection parameters dictionary: {endpoint=, database=, credentials=}
         :param table_name
         """
-        driver_config = ydb.DriverConfig(**connection_params)
-
-        driver = ydb.Driver(driver_config)
-
-        try:
-            driver.wait(timeout=5)
-            print('Successfully connected to YDB')
-        except:
-            print('Connect failed to YDB')
-            print(driver.discovery_debug_details())
-            return
-
-        self.session = driver.table_client.session().create()
+        self.pool = get_session_pool(connection_params)
 
+        self.database = connection_params['database']
         self.table_name = table_name
+        self.indexes = INDEXES.get(table_name, {})
+        self.columns = None
+        self.queries = {}
         # self.create_tables()
 
     def add(self, entity):
@@ -38,15 +113,13 @@ class YandexDatabase(Database):
         Adds a new entity.
         :param entity: Dictionary containing the values of the entity to be added.
         """
-        entity_values = list(entity.values())
+        columns = list(entity.keys())
 
-        entity_values = self.prepare_values(entity_values)
-
-        columns = ', '.join(entity.keys())
-        values = ', '.join(entity_values)
-
-        query = f"INSERT INTO {self.table_name} ({columns}) VALUES ({values})"
-        result = self.session.transaction().execute(query, commit_tx=True)
+        query = self.get_query('add', [(column, column) for column in columns], lambda: (
+            f"INSERT INTO {self.table_name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('$' + column for column in columns)})"
+        ))
+        result = self.execute(query, self.get_parameters([(column, column, entity[column]) for column in columns]))
 
         if result is not None:
             return entity['id']
@@ -59,28 +132,113 @@ class YandexDatabase(Database):
         :param entity_id: The ID of the entity to be updated.
         :param entity: List of new values of the entity.
         """
-        entity_id = "'" + entity_id + "'"
-
-        entity_values = list(entity.values())
+        columns = list(entity.keys())
 
-        entity_values = self.prepare_values(entity_values)
+        params = [(column, column) for column in columns] + [('entity_id', 'id')]
 
-        set_query = ', '.join([f'{k} = %s' for k in entity.keys()])
-
-        query = f"UPDATE {self.table_name} SET {set_query} WHERE id = %s" % tuple(entity_values + [entity_id])
-        result = self.session.transaction().execute(query, commit_tx=True)
+        query = self.get_query('update', params, lambda: (
+            f"UPDATE {self.table_name} SET {', '.join(f'{column} = ${column}' for column in columns)} "
+            f"WHERE id = $entity_id"
+        ))
+        result = self.execute(query, self.get_parameters(
+            [(column, column, entity[column]) for column in columns] + [('entity_id', 'id', entity_id)]
+        ))
 
         if result is not None:
             return True
         else:
             return None
 
+    def update_if(self, entity_id, condition, entity):
+        """
+        Updates an existing entity if it matches the condition, atomically.
+        Returns True if the entity was updated.
+        :param entity_id: The ID of the entity to be updated.
+        :param condition: A dictionary containing the values the entity should have.
+        :param entity: List of new values of the entity.
+        """
+        columns = list(entity.keys())
+        conditions = list(condition.keys())
+
+        params = ([(column, column) for column in columns] + [('entity_id', 'id')]
+                  + [(f'expected_{column}', column) for column in conditions])
+
+        query = self.get_query('update_if', params, lambda: (
+            f"$found = SELECT id FROM {self.table_name} WHERE id == $entity_id"
+            f"{''.join(f' AND {column} == $expected_{column}' for column in conditions)};\n"
+            f"SELECT COUNT(*) AS count FROM $found;\n"
+            f"UPDATE {self.table_name} ON SELECT id, "
+            f"{', '.join(f'${column} AS {column}' for column in columns)} FROM $found"
+        ))
+        result = self.execute(query, self.get_parameters(
+            [(column, column, entity[column]) for column in columns] + [('entity_id', 'id', entity_id)]
+            + [(f'expected_{column}', column, value) for column, value in condition.items()]
+        ))
+
+        return result[0].rows[0]['count'] > 0
+
     def delete(self, entity_id):
         """
         Deletes an existing entity.
         :param entity_id: The ID of the entity to be deleted.
         """
-        self.session.execute_scheme(f"DELETE FROM {self.table_name} WHERE id = %s", (entity_id,))
+        query = self.get_query('delete', [('entity_id', 'id')], lambda: (
+            f"DELETE FROM {self.table_name} WHERE id = $entity_id"
+        ))
+        self.execute(query, self.get_parameters([('entity_id', 'id', entity_id)]))
+
+    def add_many(self, entities):
+        """
+        Adds new entities.
+        :param entities: A list of dictionaries containing the values of the entities to be added.
+        """
+        return self.write_many('add_many', 'INSERT INTO', entities)
+
+    def upsert_many(self, entities):
+        """
+        Adds new entities or replaces the values of the existing ones.
+        :param entities: A list of dictionaries containing the values of the entities, including id.
+        """
+        return self.write_many('upsert_many', 'UPSERT INTO', entities)
+
+    def update_many(self, entities):
+        """
+        Updates existing entities, missing ones are skipped.
+        :param entities: A list of dictionaries containing the new values of the entities, including id.
+        """
+        return self.write_many('update_many', 'UPDATE', entities, 'ON ')
+
+    def update_many_if(self, entities, condition):
+        """
+        Updates existing entities which match the condition, atomically per batch of rows.
+        Returns ids of the updated entities.
+        :param entities: A list of dictionaries containing the new values of the entities, including id.
+        :param condition: A dictionary containing the values the entities should have.
+        """
+        if not entities:
+            return set()
+
+        conditions = list(condition.keys())
+
+        params = [(f'expected_{column}', column) for column in conditions]
+        parameters = self.get_parameters([(f'expected_{column}', column, value) for column, value in condition.items()])
+
+        updated = set()
+
+        for columns, group in self.group_by_columns(entities).items():
+            query = self.get_query(('update_many_if', columns), params, lambda: (
+                f"DECLARE $rows AS {self.get_rows_type(columns)};\n"
+                f"$matched = SELECT r.* FROM AS_TABLE($rows) AS r JOIN {self.table_name} AS t ON r.id == t.id "
+                f"WHERE {' AND '.join(f't.{column} == $expected_{column}' for column in conditions)};\n"
+                f"SELECT id FROM $matched;\n"
+                f"UPDATE {self.table_name} ON SELECT * FROM $matched"
+            ))
+
+            for rows in self.get_rows(columns, group):
+                result = self.execute(query, {**parameters, '$rows': rows})
+                updated.update(row['id'] for row in self.decode_rows(result))
+
+        return updated
 
     def get_one(self, select, filter):
         """
@@ -88,92 +246,367 @@ class YandexDatabase(Database):
         :param select: A list of columns to be selected.
         :param filter: A dictionary containing the filter conditions.
         """
-        filter_values = list(filter.values())
+        rows = self.decode_rows(self.execute(*self.get_select_query('get_one', select, filter, 'LIMIT 1')))
 
-        filter_values = self.prepare_values(filter_values)
+        if rows:
+            return rows[0]
+        else:
+            return None
 
-        select_query = ', '.join(select)
-        filter_query = ' AND '.join([f'{k} == %s' for k in filter.keys()])
+    def get_list(self, select, filter):
+        """
+        Retrieves list of entities.
+        :param select: A list of columns to be selected.
+        :param filter: A dictionary containing the filter conditions.
+        """
+        return self.decode_rows(self.execute(*self.get_select_query('get_list', select, filter)))
 
-        query = f"SELECT {select_query} FROM {self.table_name} WHERE {filter_query}" % tuple(filter_values)
-        result = self.session.transaction().execute(query, commit_tx=True)
+    def get_page(self, select, filter, order, limit, cursor=None):
+        """
+        Retrieves a page of entities in descending keyset order.
+        :param select: A list of columns to be selected.
+        :param filter: A dictionary containing the filter conditions.
+        :param order: A list of columns the entities are ordered by, the last one should be unique.
+        :param limit: Maximum number of entities.
+        :param cursor: Values of the order columns of the last entity of the previous page.
+        """
+        suffix = f"ORDER BY {', '.join(f'{column} DESC' for column in order)} LIMIT {int(limit)}"
+        cursor = dict(zip(order, cursor)) if cursor is not None else None
 
-        rows = result[0].rows
+        return self.decode_rows(self.execute(*self.get_select_query('get_page', select, filter, suffix, cursor)))
 
-        if rows and len(rows) > 0:
-            row = rows[0]
+    def lease_until(self, select, filter, column, value, limit, lease):
+        """
+        Retrieves entities whose column value is not after the given one or is not set, in ascending order
+        of the column, and sets their column to the lease value in the same transaction,
+        so concurrent callers get different entities until the lease expires.
+        :param select: A list of columns to be selected.
+        :param filter: A dictionary containing the filter conditions.
+        :param column: Column the entities are ordered by.
+        :param value: Maximum value of the column.
+        :param limit: Maximum number of entities.
+        :param lease: New value of the column.
+        """
+        query, parameters = self.get_select_query(
+            'lease_until', select, filter, f"ORDER BY {column} LIMIT {int(limit)}",
+            until={column: value}, lease={column: lease}
+        )
+
+        return self.decode_rows(self.execute(query, parameters))
+
+    def count(self, filter):
+        """
+        Counts entities.
+        :param filter: A dictionary containing the filter conditions.
+        """
+        rows = self.decode_rows(self.execute(*self.get_select_query('count', ['COUNT(*) AS count'], filter)))
 
+        return rows[0]['count'] if rows else 0
+
+    @staticmethod
+    def decode_rows(result):
+        """
+        Returns the rows of the query result with String values decoded.
+        """
+        rows = result[0].rows
+
+        for row in rows:
             for k, v in row.items():
                 if isinstance(v, (bytes, bytearray)):
                     row[k] = v.decode('utf8')
 
-            return row
-        else:
+        return rows
+
+    def create_tables(self):
+        """
+        Creates the missing tables and adds the missing columns and secondary indexes to the existing ones,
+        so the method can be run again after the schema changes.
+        """
+        for table_name, script in TABLES.items():
+            description = self.describe_table(table_name)
+
+            if description is None:
+                indexes = ''.join(
+                    f",\n            INDEX {name} GLOBAL ON ({', '.join(columns)})"
+                    for name, columns in INDEXES.get(table_name, {}).items()
+                )
+                command = f"CREATE TABLE {table_name} ({script}{indexes}\n        )"
+                self.pool.retry_operation_sync(lambda session: session.execute_scheme(command))
+                continue
+
+            existing = {column.name for column in description.columns}
+
+            for line in script.strip().splitlines():
+                name, column_type = line.strip().rstrip(',').split()[:2]
+
+                if name in existing or name == 'PRIMARY':
+                    continue
+
+                command = f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"
+                self.pool.retry_operation_sync(lambda session: session.execute_scheme(command))
+
+            existing = {index.name for index in description.indexes}
+
+            for name, columns in INDEXES.get(table_name, {}).items():
+                if name in existing:
+                    continue
+
+                command = f"ALTER TABLE {table_name} ADD INDEX {name} GLOBAL ON ({', '.join(columns)})"
+                self.pool.retry_operation_sync(lambda session: session.execute_scheme(command))
+
+    def describe_table(self, table_name):
+        """
+        Returns the table description or None if the table does not exist.
+        """
+        try:
+            return self.pool.retry_operation_sync(
+                lambda session: session.describe_table(f'{self.database}/{table_name}')
+            )
+        except ydb.SchemeError:
             return None
 
-    def get_list(self, select, filter):
+    def execute(self, query, parameters=None):
         """
-        Retrieves list of entities.
+        Executes a query in a pooled session, retrying on retryable errors.
+        Queries with parameters are prepared, prepared queries are cached by the session.
+        :param query: YQL query text.
+        :param parameters: Dictionary of the query parameter values: {'$name': value}
+        """
+        def callee(session):
+            if parameters is None:
+                return session.transaction().execute(query, commit_tx=True)
+
+            prepared_query = session.prepare(query)
+            return session.transaction().execute(prepared_query, parameters, commit_tx=True)
+
+        return self.pool.retry_operation_sync(callee)
+
+    def write_many(self, operation, statement, entities, source_prefix=''):
+        """
+        Writes entities with a single query per batch of rows, passing the rows as a list parameter:
+        <statement> table [ON] SELECT * FROM AS_TABLE($rows)
+        Entities with different sets of columns are written by separate queries, so the columns
+        an entity does not have are not changed by UPDATE or written as NULL.
+        :param operation: Operation name the query text is cached by.
+        :param statement: INSERT INTO, UPSERT INTO or UPDATE.
+        :param entities: A list of dictionaries containing the values of the entities.
+        :param source_prefix: Keyword before the SELECT.
+        """
+        if not entities:
+            return 0
+
+        for columns, group in self.group_by_columns(entities).items():
+            key = (operation, columns)
+
+            if key not in self.queries:
+                self.queries[key] = (
+                    f"DECLARE $rows AS {self.get_rows_type(columns)};\n"
+                    f"{statement} {self.table_name} {source_prefix}SELECT * FROM AS_TABLE($rows)"
+                )
+
+            for rows in self.get_rows(columns, group):
+                self.execute(self.queries[key], {'$rows': rows})
+
+        return len(entities)
+
+    @staticmethod
+    def group_by_columns(entities):
+        """
+        Returns the entities grouped by their columns: {(column, ...): [entity, ...]}.
+        Columns are sorted, so entities with the same columns in a different order share a group.
+        """
+        groups = {}
+
+        for entity in entities:
+            groups.setdefault(tuple(sorted(entity.keys())), []).append(entity)
+
+        return groups
+
+    def get_rows_type(self, columns):
+        """
+        Returns the YQL type of the list of rows with the columns.
+        """
+        types = self.get_columns()
+
+        return f"List<Struct<{', '.join(f'{column}: {types[column]}' for column in columns)}>>"
+
+    def get_rows(self, columns, entities):
+        """
+        Yields batches of the entities converted to the list parameter rows.
+        """
+        types = self.get_columns()
+
+        for start in range(0, len(entities), self.BATCH_SIZE):
+            yield [
+                {column: self.convert_value(types[column], entity.get(column)) for column in columns}
+                for entity in entities[start:start + self.BATCH_SIZE]
+            ]
+
+    def get_select_query(self, operation, select, filter, suffix='', cursor=None, until=None, lease=None):
+        """
+        Returns a select query and its parameters.
+        :param operation: Operation name the query text is cached by.
         :param select: A list of columns to be selected.
-        :param filter: A dictionary containing the filter conditions.
+        :param filter: A dictionary containing the filter conditions, a list value matches any of its items.
+        :param suffix: Query text added after the filter conditions.
+        :param cursor: A dictionary of the keyset columns values, rows before them in descending order are selected.
+        :param until: A dictionary of the maximum column values, rows without the value are selected too.
+        :param lease: A dictionary of the column values the selected rows are updated with in the same transaction.
         """
-        filter_values = list(filter.values())
+        select = [select] if isinstance(select, str) else list(select)
+        columns = list(filter.keys())
 
-        filter_values = self.prepare_values(filter_values)
+        params = []
+        conditions = []
 
-        select_query = ', '.join(select)
-        filter_query = ' AND '.join([f'{k} == %s' for k in filter.keys()])
+        for column in columns:
+            if isinstance(filter[column], (list, tuple, set)):
+                params.append((column, column, True))
+                conditions.append(f'{column} IN ${column}')
+            else:
+                params.append((column, column))
+                conditions.append(f'{column} == ${column}')
 
-        query = f"SELECT {select_query} FROM {self.table_name} WHERE {filter_query}" % tuple(filter_values)
-        result = self.session.transaction().execute(query, commit_tx=True)
+        values = [(column, column, filter[column]) for column in columns]
 
-        rows = result[0].rows
+        if cursor is not None:
+            params += [(f'cursor_{column}', column) for column in cursor]
+            values += [(f'cursor_{column}', column, value) for column, value in cursor.items()]
+            conditions.append(self.get_keyset_condition(list(cursor)))
 
-        if rows and len(rows) > 0:
+        if until is not None:
+            params += [(f'until_{column}', column) for column in until]
+            values += [(f'until_{column}', column, value) for column, value in until.items()]
+            conditions += [f'({column} IS NULL OR {column} <= $until_{column})' for column in until]
 
-            for i, row in enumerate(rows):
-                for k, v in row.items():
-                    if isinstance(v, (bytes, bytearray)):
-                        rows[i][k] = v.decode('utf8')
+        source = self.table_name
+        index = self.get_index(columns + list(until or {}))
 
-            return rows
-        else:
-            return []
+        if index is not None:
+            source += f' VIEW {index}'
 
-    def create_tables(self):
-        script = '''
-        CREATE TABLE users (
-            id String NOT NULL,
-            account_id Uint64,
-            chat_id Uint64,
-            name String,
-            phone String,
-            created_at Datetime,
-            PRIMARY KEY (id)
-        );
-        CREATE TABLE requests (
-            id String NOT NULL,
-            stage String,
-            user_id String,
-            operation_id String,
-            file_name String,
-            attempt Uint64,
-            created_at Datetime,
-            PRIMARY KEY (id)
-        )
-        '''
-        sql_commands = script.split(';')
+        text = f"SELECT {', '.join(select)} FROM {source} WHERE {' AND '.join(conditions)} {suffix}"
+
+        if lease is not None:
+            params += [(f'lease_{column}', column) for column in lease]
+            values += [(f'lease_{column}', column, value) for column, value in lease.items()]
+            text = (
+                f"$rows = {text};\n"
+                f"SELECT * FROM $rows;\n"
+                f"UPDATE {self.table_name} ON SELECT id, "
+                f"{', '.join(f'$lease_{column} AS {column}' for column in lease)} FROM $rows"
+            )
+
+        query = self.get_query((operation, tuple(select), suffix), params, lambda: text)
+
+        return query, self.get_parameters(values)
+
+    @staticmethod
+    def get_keyset_condition(columns):
+        """
+        Returns the condition selecting rows before the cursor in descending order of the columns:
+        (a < $cursor_a OR (a == $cursor_a AND b < $cursor_b))
+        """
+        column = columns[0]
+        condition = f'{column} < $cursor_{column}'
+
+        if len(columns) > 1:
+            condition += f' OR ({column} == $cursor_{column} AND {YandexDatabase.get_keyset_condition(columns[1:])})'
+
+        return f'({condition})'
+
+    def get_index(self, columns):
+        """
+        Returns the name of the secondary index to read by the filter columns or None.
+        The index with the longest prefix of the filter columns is chosen.
+        Filters by the primary key are read from the table itself.
+        :param columns: Filter columns.
+        """
+        if 'id' in columns:
+            return None
+
+        best, best_length = None, 0
+
+        for name, index_columns in self.indexes.items():
+            length = 0
+
+            while length < len(index_columns) and index_columns[length] in columns:
+                length += 1
+
+            if length > best_length:
+                best, best_length = name, length
+
+        return best
+
+    def get_query(self, operation, params, build):
+        """
+        Returns a query text with declared parameters.
+        Texts are cached by operation and parameter columns, so a query of the same shape always has
+        the same text and is compiled by YDB only once per session.
+        :param operation: Operation name.
+        :param params: List of (parameter name, column name) pairs, (parameter name, column name, True)
+            for a list of the column values.
+        :param build: Function returning the query text without declarations.
+        """
+        key = (operation, tuple(params))
+
+        if key not in self.queries:
+            declarations = ''.join(f"DECLARE ${param[0]} AS {self.get_type(*param[1:])};\n" for param in params)
+            self.queries[key] = declarations + build()
+
+        return self.queries[key]
+
+    def get_parameters(self, values):
+        """
+        Returns query parameter values converted to the column types.
+        :param values: List of (parameter name, column name, value) tuples.
+        """
+        columns = self.get_columns()
+
+        return {f'${name}': self.convert_value(columns[column], value) for name, column, value in values}
+
+    def get_type(self, column, many=False):
+        """
+        Returns the YQL type of the column or of the list of the column values.
+        """
+        column_type = self.get_columns()[column]
+
+        if not many:
+            return column_type
+
+        if isinstance(column_type, ydb.OptionalType):
+            column_type = column_type.item
+
+        return f'List<{column_type}>'
+
+    def get_columns(self):
+        """
+        Returns the table column types. The table is described once.
+        """
+        if self.columns is None:
+            description = self.describe_table(self.table_name)
+            self.columns = {column.name: column.type for column in description.columns}
+
+        return self.columns
+
+    @staticmethod
+    def convert_value(column_type, value):
+        """
+        Converts a value to the type expected by YDB SDK for the column type.
+        """
+        if value is None:
+            return None
+
+        if isinstance(value, (list, tuple, set)):
+            return [YandexDatabase.convert_value(column_type, item) for item in value]
 
-        for command in sql_commands:
-            self.session.execute_scheme(command)
+        if isinstance(column_type, ydb.OptionalType):
+            column_type = column_type.item
 
-    def prepare_values(self, values):
-        for i, val in enumerate(values):
-            if isinstance(val, str):
-                val = "'" + val.replace("'", "\"") + "'"
-            if isinstance(val, datetime.datetime):
-                val = f"DATETIME('{val.strftime('%Y-%m-%dT%H:%M:%SZ')}')"
+        if column_type == ydb.PrimitiveType.String and isinstance(value, str):
+            return value.encode('utf8')
 
-            values[i] = str(val)
+        if column_type == ydb.PrimitiveType.Datetime and isinstance(value, datetime.datetime):
+            return calendar.timegm(value.timetuple())
 
-        return values
+        return value
@@ -1,7 +1,7 @@
 from .contact import contact
 from .demo import demo
 from .help import help
-from .my_files import my_files, back_to_list
+from .my_files import my_files, back_to_list, next_page
 from .not_ready import not_ready
 from .sign_up import sign_up
 from .upload import upload
@@ -12,6 +12,7 @@ all_handlers = [
     my_files,
     not_ready,
     back_to_list,
+    next_page,
     help,
     contact,
     demo
@@ -13,16 +13,23 @@ user_repository: UserRepository = locator.get('user_repository')
 
 request_repository: RequestRepository = locator.get('request_repository')
 
+# Number of files on a page of the list
+PAGE_SIZE = 10
+
 
 async def myfiles_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Returns a list of uploaded files.
     """
     query = update.callback_query
+    cursor = None
 
     if query is not None:
         await query.answer()
 
+        if query.data.startswith(State.NEXT_PAGE.value + ':'):
+            cursor = query.data[len(State.NEXT_PAGE.value) + 1:]
+
     # Check if user exists in the database
     try:
         user = user_repository.get_by_account_id(account_id=update.effective_user.id)
@@ -38,7 +45,7 @@ async def myfiles_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Get user's requests
     try:
-        analysis_requests = request_repository.get_by_user_id(user_id)
+        analysis_requests, next_cursor = request_repository.get_page(user_id, PAGE_SIZE, cursor)
     except Exception as e:
         print(f"Error: '{e}' occurred")
         return
@@ -69,6 +76,10 @@ async def myfiles_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard.append(row)
         row = []
 
+    if next_cursor is not None:
+        keyboard.append([InlineKeyboardButton(Loc.get_message('NEXT_PAGE'),
+                                              callback_data=f'{State.NEXT_PAGE.value}:{next_cursor}')])
+
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     if button is not None:
@@ -91,3 +102,4 @@ async def myfiles_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 my_files = CommandHandler('myfiles', myfiles_callback)
 back_to_list = CallbackQueryHandler(myfiles_callback, pattern='^' + State.BACK_TO_LIST.value + '$')
+next_page = CallbackQueryHandler(myfiles_callback, pattern='^' + State.NEXT_PAGE.value + ':')
@@ -1,16 +1,19 @@
+import hashlib
 import os.path
-import tempfile
 import time
-import soundfile as sf
 
 from telegram import Update
 from telegram.ext import (ContextTypes, CommandHandler, MessageHandler, ConversationHandler, filters)
 
 from ..constants import (Stage, State)
+from ..repository.file_repository import FileRepository
 from ..repository.request_repository import RequestRepository
 from ..repository.user_repository import UserRepository
 from ..service_locator import ServiceLocator
 from .cancel import cancel
+from ..service import audio_probe
+from ..service.executor import run_blocking
+from ..service.file_stream import iter_file, read_header
 from ..service.storage import Storage
 from ..service.rest_client import RestClient
 from ..service.localization import Loc
@@ -20,10 +23,17 @@ locator = ServiceLocator()
 user_repository: UserRepository = locator.get('user_repository')
 
 request_repository: RequestRepository = locator.get('request_repository')
+file_repository: FileRepository = locator.get('file_repository')
 
 file_storage: Storage = locator.get('file_storage')
 rest_client: RestClient = locator.get('rest_client')
 
+# Maximum bytes of the file read to validate it before the upload
+MAX_HEADER_SIZE = 1024 * 1024
+
+# Maximum duration of the record, in seconds
+MAX_DURATION = 2 * 60 * 60
+
 
 async def get_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -39,9 +49,7 @@ async def get_file_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             return ConversationHandler.END
 
-        analysis_requests = request_repository.get_by_user_id(user['id'])
-
-        if len(analysis_requests) >= 5:
+        if request_repository.count_by_user_id(user['id']) >= 5:
             text = Loc.get_message('FILE_LIMIT_REACHED')
             await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
@@ -63,10 +71,14 @@ async def upload_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Upload file into storage
     file_id = None
 
+    duration = None
+
     if update.message.voice:
         file_id = update.message.voice.file_id
+        duration = update.message.voice.duration
     elif update.message.audio:
         file_id = update.message.audio.file_id
+        duration = update.message.audio.duration
 
     if file_id:
         file = await context.bot.get_file(file_id)
@@ -90,18 +102,57 @@ async def upload_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_name, file_extension = os.path.splitext(filename)
         filename_with_timestamp = f"{file_name}_{timestamp}{file_extension}"
 
-        filepath = tempfile.gettempdir() + '/' + filename_with_timestamp
-        await file.download_to_drive(filepath)
-
-        if not validate_channel_count(filepath):
-            text = Loc.get_message('CHANNEL_COUNT_ERROR')
+        if not validate_duration(duration):
+            text = Loc.get_message('DURATION_ERROR')
             await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
             return State.UPLOAD.value
 
-        file_storage.upload(filepath)
+        # Only the header is read before validation, the rest is streamed to the storage as it is downloaded
+        chunks = iter_file(file)
+
+        try:
+            header, content = await read_header(chunks, audio_probe.HEADER_SIZE)
+
+            header_size = audio_probe.get_header_size(header)
+
+            if len(header) < header_size <= MAX_HEADER_SIZE:
+                header, content = await read_header(content, header_size)
+
+            # A larger header is an MP3 ID3 tag with a large cover image, the audio header after it is not read
+            info = audio_probe.probe(header, file.file_size) if header_size <= MAX_HEADER_SIZE else None
 
-        # Get operationId from response
-        operation_id = rest_client.upload_file(filename_with_timestamp, update.effective_user.id)
+            if info is None:
+                text = Loc.get_message('FILE_HEADER_ERROR')
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+                return State.UPLOAD.value
+
+            if not validate_channel_count(info):
+                text = Loc.get_message('CHANNEL_COUNT_ERROR')
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+                return State.UPLOAD.value
+
+            if not duration and not validate_duration(info.duration):
+                text = Loc.get_message('DURATION_ERROR')
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+                return State.UPLOAD.value
+
+            operation_id, uploaded_request = await upload_stream(content, filename_with_timestamp,
+                                                                 update.effective_user.id)
+        finally:
+            # The download is closed here if the file is rejected or its upload fails
+            await chunks.aclose()
+
+        # A file uploaded before keeps its request, so it is not counted toward the limit again
+        if uploaded_request is not None:
+            done = uploaded_request['stage'] == Stage.SUCCESS.value
+            text = Loc.get_message('UPLOAD_DUPLICATE' if done else 'UPLOAD_SUCCESS')
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text, parse_mode='markdown')
+            return ConversationHandler.END
+
+        if operation_id is None:
+            text = Loc.get_message('UPLOAD_ERROR')
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+            return ConversationHandler.END
 
     # Find user in users table by telegram account id
     try:
@@ -164,16 +215,58 @@ def validate_file_size(file_size):
     return file_size < max_file_size_mb
 
 
-def validate_channel_count(filepath):
+def validate_channel_count(info):
     """
-    Validates upload file channel count.
+    Validates upload file channel count by the probed file header.
     """
+    return info is not None and info.channels >= 2
+
+
+def validate_duration(duration):
+    """
+    Validates upload file duration, unknown duration is allowed.
+    """
+    return not duration or duration <= MAX_DURATION
+
+
+async def upload_stream(content, filename, account_id):
+    """
+    Uploads the file content stream into storage and sends the file to analysis.
+    A file the user has uploaded before is recognized by SHA-256 of the content computed while streaming:
+    it is not stored, and its request is reused unless the analysis failed.
+    Returns the operation id and the request of the file uploaded before or None.
+    """
+    upload = file_storage.create_upload(filename, {'account-id': account_id})
+    digest = hashlib.sha256()
+
     try:
-        audio_file = sf.SoundFile(filepath)
-        channels = audio_file.channels
-        return channels >= 2
-    except Exception as e:
-        return False
+        async for chunk in content:
+            digest.update(chunk)
+            await run_blocking(upload.write, chunk)
+
+        file_id = f'{account_id}:{digest.hexdigest()}'
+
+        uploaded = file_repository.get_by_id(file_id)
+
+        if uploaded is not None:
+            request = request_repository.get_by_operation_id(uploaded['operation_id'])
+
+            if request is not None and request['stage'] != Stage.FAILED.value:
+                await run_blocking(upload.abort)
+                return uploaded['operation_id'], request
+
+        await run_blocking(upload.complete)
+    except Exception:
+        await run_blocking(upload.abort)
+        raise
+
+    # Get operationId from response
+    operation_id = await rest_client.upload_file(filename, account_id)
+
+    if operation_id is not None:
+        file_repository.save({'id': file_id, 'operation_id': operation_id, 'file_name': filename})
+
+    return operation_id, None
 
 
 upload = ConversationHandler(
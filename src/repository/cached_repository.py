@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+
+class CachedRepository:
+    """
+    Read-through cache decorator over a repository.
+    Results of the ``get_*`` methods are cached by method and arguments with LRU eviction and TTL,
+    any other method call (add, update, delete) invalidates the cache.
+    Empty results are not cached, so an entity added by another container is found right away.
+    """
+
+    def __init__(self, repository, ttl=60, max_size=1024):
+        """
+        :param repository: Repository to cache.
+        :param ttl: Time in seconds a result is kept.
+        :param max_size: Maximum number of cached results.
+        """
+        self.repository = repository
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repository, name)
+
+        if not callable(attribute):
+            return attribute
+
+        if name.startswith('get_'):
+            return lambda *args, **kwargs: self._get(name, attribute, args, kwargs)
+
+        def call(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.invalidate()
+
+        return call
+
+    def invalidate(self):
+        """
+        Clears the cache.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def _get(self, name, method, args, kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+
+        try:
+            hash(key)
+        except TypeError:
+            # Lists and other unhashable arguments are not cached
+            return method(*args, **kwargs)
+
+        with self._lock:
+            if key in self._cache:
+                expires_at, value = self._cache[key]
+
+                if expires_at > now:
+                    self._cache.move_to_end(key)
+                    return deepcopy(value)
+
+                del self._cache[key]
+
+        value = method(*args, **kwargs)
+
+        if not value:
+            return value
+
+        with self._lock:
+            self._cache[key] = (now + self.ttl, deepcopy(value))
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return value
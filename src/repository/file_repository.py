@@ -0,0 +1,16 @@
+import datetime
+
+from ..database.database import Database
+
+
+class FileRepository:
+
+    def __init__(self, database: Database):
+        self.database = database
+
+    def save(self, fields):
+        fields['created_at'] = datetime.datetime.now()
+        return self.database.upsert_many(entities=[fields])
+
+    def get_by_id(self, file_id):
+        return self.database.get_one('*', {'id': file_id})
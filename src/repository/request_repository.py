@@ -1,27 +1,115 @@
 import datetime
 import uuid
 
+from ..constants import Stage
 from ..database.database import Database
 
 
 class RequestRepository:
 
-    def __init__(self, database: Database):
+    def __init__(self, database: Database, first_check_delay=0):
+        """
+        :param first_check_delay: Seconds after creation the result checker first checks the request.
+        """
         self.database = database
+        self.first_check_delay = datetime.timedelta(seconds=first_check_delay)
 
     def add(self, fields):
         fields['id'] = str(uuid.uuid4())[:8]
         fields['created_at'] = datetime.datetime.now()
+        fields.setdefault('next_check_at', fields['created_at'] + self.first_check_delay)
         return self.database.add(entity=fields)
 
     def update(self, request_id, fields):
         return self.database.update(entity_id=request_id, entity=fields)
 
+    def add_many(self, fields_list):
+        for fields in fields_list:
+            fields['id'] = str(uuid.uuid4())[:8]
+            fields['created_at'] = datetime.datetime.now()
+            fields.setdefault('next_check_at', fields['created_at'] + self.first_check_delay)
+        return self.database.add_many(entities=fields_list)
+
+    def upsert_many(self, requests):
+        return self.database.upsert_many(entities=requests)
+
+    def update_many(self, requests):
+        return self.database.update_many(entities=requests)
+
     def delete(self, request_id):
         return self.database.delete(entity_id=request_id)
 
     def get_by_user_id(self, user_id):
         return self.database.get_list('*', {'user_id': user_id})
 
+    def get_page(self, user_id, limit, cursor=None):
+        """
+        Returns a page of user's requests, newest first, and the cursor of the next page or None.
+        :param cursor: Cursor returned with the previous page.
+        """
+        if cursor is not None:
+            created_at, request_id = cursor.split(':', 1)
+            cursor = [int(created_at), request_id]
+
+        requests = self.database.get_page(
+            ['id', 'stage', 'file_name', 'operation_id', 'created_at'],
+            {'user_id': user_id},
+            ['created_at', 'id'],
+            limit + 1,
+            cursor
+        )
+
+        if len(requests) <= limit:
+            return requests, None
+
+        last = requests[limit - 1]
+
+        return requests[:limit], f"{last['created_at']}:{last['id']}"
+
+    def count_by_user_id(self, user_id):
+        return self.database.count({'user_id': user_id})
+
+    def lease_due(self, now, limit, lease):
+        """
+        Returns processing requests due for the result check, the earliest first,
+        and postpones their next check by the lease seconds, so other checkers skip them meanwhile.
+        """
+        return self.database.lease_until('*', {'stage': Stage.PROCESS.value}, 'next_check_at', now, limit,
+                                         now + lease)
+
+    def update_processing(self, requests):
+        """
+        Updates the requests which are still processing. Returns ids of the updated requests.
+        """
+        return self.database.update_many_if(requests, {'stage': Stage.PROCESS.value})
+
+    def get_by_operation_id(self, operation_id):
+        """
+        Returns the request of the analysis: a succeeded one, otherwise a not failed one, the newest of them.
+        Files uploaded again by earlier versions have several requests with the same analysis.
+        """
+        requests = self.get_list_by_operation_id(operation_id)
+
+        if not requests:
+            return None
+
+        return max(requests, key=lambda request: (
+            request['stage'] == Stage.SUCCESS.value,
+            request['stage'] != Stage.FAILED.value,
+            request['created_at'] or 0,
+        ))
+
+    def get_list_by_operation_id(self, operation_id):
+        return self.database.get_list('*', {'operation_id': operation_id})
+
+    def complete(self, request_id):
+        """
+        Moves the request from processing to success. Returns False if it was not processing.
+        """
+        return self.database.update_if(request_id, {'stage': Stage.PROCESS.value}, {
+            'stage': Stage.SUCCESS.value,
+            'next_check_at': None,
+        })
+
     def get_by_id(self, request_id):
         return self.database.get_one('*', {'id': request_id})
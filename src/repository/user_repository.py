@@ -17,8 +17,26 @@ class UserRepository:
     def update(self, user_id, fields):
         return self.database.update(entity_id=user_id, entity=fields)
 
+    def add_many(self, fields_list):
+        for fields in fields_list:
+            fields['id'] = str(uuid.uuid4())[:8]
+            fields['created_at'] = datetime.datetime.now()
+        return self.database.add_many(entities=fields_list)
+
+    def upsert_many(self, users):
+        return self.database.upsert_many(entities=users)
+
+    def update_many(self, users):
+        return self.database.update_many(entities=users)
+
     def delete(self, user_id):
         return self.database.delete(entity_id=user_id)
 
     def get_by_account_id(self, account_id):
         return self.database.get_one('*', {'account_id': account_id})
+
+    def get_by_id(self, user_id):
+        return self.database.get_one('*', {'id': user_id})
+
+    def get_by_ids(self, user_ids):
+        return self.database.get_list('*', {'id': list(user_ids)})
@@ -0,0 +1,51 @@
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+from ..repository.request_repository import RequestRepository
+from ..repository.user_repository import UserRepository
+from ..service_locator import ServiceLocator
+from .localization import Loc
+
+
+async def complete_analysis(bot: Bot, operation_id):
+    """
+    Marks the requests of the analysis as succeeded and notifies the users.
+    The request stage is changed atomically, so the user is notified once even if the result
+    checker finds the result at the same time.
+    Returns False if no request is found or all of them are already completed.
+    """
+    locator = ServiceLocator()
+
+    request_repository: RequestRepository = locator.get('request_repository')
+    user_repository: UserRepository = locator.get('user_repository')
+
+    completed = False
+
+    # A file uploaded again by earlier versions has several requests with the same analysis
+    for request in request_repository.get_list_by_operation_id(operation_id):
+        if not request_repository.complete(request['id']):
+            continue
+
+        completed = True
+
+        user = user_repository.get_by_id(request['user_id'])
+
+        if user is not None:
+            await notify_analysis_done(bot, user['chat_id'], request)
+
+    return completed
+
+
+async def notify_analysis_done(bot: Bot, chat_id, request):
+    """
+    Sends the message with the analysis result button.
+    """
+    result_url = ''
+
+    keyboard = [
+        [InlineKeyboardButton(Loc.get_message('VIEW_RESULT'), web_app=WebAppInfo(
+            url=f"{result_url}?file_id=" + request['operation_id']))],
+    ]
+
+    text = Loc.get_message('ANALYSIS_DONE', {'#FILE_NAME#': request['file_name']})
+
+    await bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -0,0 +1,202 @@
+import struct
+from typing import NamedTuple, Optional
+
+# Bytes of the file header enough to probe a file without a large ID3 tag
+HEADER_SIZE = 16 * 1024
+
+
+class AudioInfo(NamedTuple):
+    """
+    Audio stream parameters read from the file header.
+    Duration is None if it can not be found out from the header.
+    """
+    channels: int
+    sample_rate: int
+    duration: Optional[float]
+
+
+# MPEG audio bitrates, kbit/s, by (version is MPEG-1, layer) and bitrate index
+_MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# MPEG audio sample rates by version bits and sample rate index
+_MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+
+
+def probe(header, size=None) -> Optional[AudioInfo]:
+    """
+    Reads audio stream parameters from the beginning of a WAV, Ogg (Opus, Vorbis) or MP3 file.
+    Returns None if the format is not recognized or the header is incomplete.
+    :param header: First bytes of the file, bytes or memoryview.
+    :param size: Size of the whole file, used to estimate the duration of Ogg Vorbis and CBR MP3 files.
+    """
+    header = memoryview(header)
+
+    try:
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            return _probe_wav(header)
+
+        if header[:4] == b'OggS':
+            return _probe_ogg(header, size)
+
+        return _probe_mp3(header, size)
+    except (struct.error, IndexError, ZeroDivisionError):
+        return None
+
+
+def get_header_size(header) -> int:
+    """
+    Returns the number of bytes to probe the file: ID3 tag of MP3 file, which may contain cover image,
+    is skipped entirely.
+    """
+    return _get_id3_size(memoryview(header)) + HEADER_SIZE
+
+
+def _probe_wav(header) -> Optional[AudioInfo]:
+    offset = 12
+    channels = sample_rate = byte_rate = None
+
+    while offset + 8 <= len(header):
+        chunk_id = bytes(header[offset:offset + 4])
+        chunk_size, = struct.unpack_from('<I', header, offset + 4)
+
+        if chunk_id == b'fmt ':
+            _, channels, sample_rate, byte_rate = struct.unpack_from('<HHII', header, offset + 8)
+        elif chunk_id == b'data':
+            if channels is None:
+                return None
+
+            return AudioInfo(channels, sample_rate, chunk_size / byte_rate)
+
+        # Chunks are aligned to 2 bytes
+        offset += 8 + chunk_size + chunk_size % 2
+
+    return None
+
+
+def _probe_ogg(header, size) -> Optional[AudioInfo]:
+    segment_count = header[26]
+    packet = header[27 + segment_count:]
+
+    if packet[:8] == b'OpusHead':
+        # Opus is always decoded at 48 kHz, the input sample rate is informational
+        return AudioInfo(packet[9], 48000, None)
+
+    if packet[:7] == b'\x01vorbis':
+        channels, sample_rate, _, nominal_bitrate = struct.unpack_from('<BIiI', packet, 11)
+        duration = size * 8 / nominal_bitrate if size and nominal_bitrate else None
+
+        return AudioInfo(channels, sample_rate, duration)
+
+    return None
+
+
+def _get_id3_size(header) -> int:
+    if header[:3] != b'ID3' or len(header) < 10:
+        return 0
+
+    # Size is a syncsafe integer: 7 bits per byte
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    footer = 10 if header[5] & 0x10 else 0
+
+    return 10 + size + footer
+
+
+def _parse_mp3_frame(header, offset):
+    """
+    Returns (is MPEG-1, layer, bitrate, sample rate, channels, frame length) of the frame header or None.
+    """
+    if offset + 4 > len(header):
+        return None
+
+    value, = struct.unpack_from('>I', header, offset)
+
+    if value >> 21 != 0x7FF:
+        return None
+
+    version = (value >> 19) & 3
+    layer = 4 - ((value >> 17) & 3)
+    bitrate_index = (value >> 12) & 15
+    sample_rate_index = (value >> 10) & 3
+
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (value >> 9) & 1
+    channels = 1 if (value >> 6) & 3 == 3 else 2
+
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and not mpeg1:
+        length = 72 * bitrate // sample_rate + padding
+    else:
+        length = 144 * bitrate // sample_rate + padding
+
+    return mpeg1, layer, bitrate, sample_rate, channels, length
+
+
+def _probe_mp3(header, size) -> Optional[AudioInfo]:
+    offset = _get_id3_size(header)
+
+    while offset + 4 <= len(header):
+        frame = _parse_mp3_frame(header, offset)
+
+        # The next frame should follow, unless the header ends earlier, to tell a frame from random bytes
+        if frame is not None and (offset + frame[5] + 4 > len(header)
+                                  or _parse_mp3_frame(header, offset + frame[5]) is not None):
+            break
+
+        offset += 1
+    else:
+        return None
+
+    mpeg1, layer, bitrate, sample_rate, channels, _ = frame
+
+    samples_per_frame = 384 if layer == 1 else (1152 if layer == 2 or mpeg1 else 576)
+
+    frame_count = _get_vbr_frame_count(header, offset, mpeg1, channels)
+
+    if frame_count is not None:
+        duration = frame_count * samples_per_frame / sample_rate
+    elif size:
+        duration = (size - offset) * 8 / bitrate
+    else:
+        duration = None
+
+    return AudioInfo(channels, sample_rate, duration)
+
+
+def _get_vbr_frame_count(header, offset, mpeg1, channels) -> Optional[int]:
+    """
+    Returns the number of frames from Xing/Info or VBRI header of the first frame.
+    """
+    side_info = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+    xing = offset + 4 + side_info
+
+    if bytes(header[xing:xing + 4]) in (b'Xing', b'Info'):
+        flags, = struct.unpack_from('>I', header, xing + 4)
+
+        if flags & 1:
+            frame_count, = struct.unpack_from('>I', header, xing + 8)
+            return frame_count
+
+    vbri = offset + 36
+
+    if bytes(header[vbri:vbri + 4]) == b'VBRI':
+        frame_count, = struct.unpack_from('>I', header, vbri + 14)
+        return frame_count
+
+    return None
@@ -0,0 +1,52 @@
+"""
+Access to the conversation states of persistent ConversationHandler.
+
+python-telegram-bot reads the states from the persistence only on Application.initialize,
+so an application reused between invocations updates them directly. This relies on
+python-telegram-bot internals, which are checked on import, so an upgrade which changes
+them fails on start instead of losing conversation states.
+"""
+from collections import UserDict
+from typing import Optional
+
+import telegram
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.ext._utils.trackingdict import TrackingDict
+from telegram.ext._utils.types import ConversationKey
+
+
+def _check_internals():
+    if not (
+            callable(getattr(ConversationHandler, '_get_key', None))
+            and '_conversations' in getattr(ConversationHandler, '__slots__', ())
+            and issubclass(TrackingDict, UserDict)
+            and callable(getattr(TrackingDict, 'update_no_track', None))
+    ):
+        raise ImportError(
+            f"python-telegram-bot {telegram.__version__} is not supported: "
+            f"ConversationHandler internals used by {__name__} have changed"
+        )
+
+
+_check_internals()
+
+
+def get_key(handler: ConversationHandler, update: Update) -> Optional[ConversationKey]:
+    """
+    Returns the conversation key of the update or None if the update has no chat or user the handler needs.
+    """
+    try:
+        return handler._get_key(update)
+    except RuntimeError:
+        return None
+
+
+def set_state(handler: ConversationHandler, key: ConversationKey, state: Optional[object]):
+    """
+    Sets the state of the conversation without marking it as changed for the persistence.
+    """
+    if state is None:
+        handler._conversations.data.pop(key, None)
+    else:
+        handler._conversations.update_no_track({key: state})
@@ -0,0 +1,16 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Shared pool for blocking network and disk I/O (boto3, file system).
+# Bounded, so a burst of concurrent updates does not open an unlimited number of connections.
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('IO_THREADS', 8)), thread_name_prefix='io')
+
+
+async def run_blocking(function, *args, **kwargs):
+    """
+    Runs a blocking function in the I/O thread pool without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(function, *args, **kwargs))
@@ -0,0 +1,65 @@
+from typing import AsyncIterator, Optional, Tuple
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import httpx
+from telegram import File
+
+# Client of the container for file downloads, keeps the connections to Telegram alive between invocations
+_client: Optional[httpx.AsyncClient] = None
+
+CHUNK_SIZE = 256 * 1024
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(30, connect=5))
+
+    return _client
+
+
+def get_file_url(file: File) -> str:
+    """
+    Returns the download URL of the Telegram file.
+    File.file_path holds the full URL, non-ASCII characters of its path are quoted.
+    """
+    url = urlsplit(file.file_path)
+
+    return urlunsplit(url._replace(path=quote(url.path)))
+
+
+async def iter_file(file: File, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Yields the Telegram file content by chunks as it is downloaded, without storing the whole file.
+    The response is open until the iterator is exhausted or closed with aclose().
+    """
+    async with get_client().stream('GET', get_file_url(file)) as response:
+        response.raise_for_status()
+
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+
+
+async def read_header(chunks: AsyncIterator[bytes], size: int) -> Tuple[bytes, AsyncIterator[bytes]]:
+    """
+    Reads at least size bytes from the stream, or the whole stream if it is shorter.
+    Returns the read bytes and the stream of the whole content, including the read bytes.
+    """
+    header = bytearray()
+
+    async for chunk in chunks:
+        header += chunk
+
+        if len(header) >= size:
+            break
+
+    header = bytes(header)
+
+    async def content():
+        yield header
+
+        async for rest in chunks:
+            yield rest
+
+    return header, content()
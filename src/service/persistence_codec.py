@@ -0,0 +1,199 @@
+import json
+import pickle
+import zlib
+from typing import Any, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class PersistenceCodec:
+    """
+    Persistence blob codec.
+    A blob consists of a header (magic bytes, format version, serializer id, compression id)
+    and the serialized, optionally compressed, data.
+    Blobs without the header are read as plain pickle data written by earlier versions:
+    the single ``persistence`` object, which S3Persistence moves to the sharded layout with this
+    codec on first start, and the objects of deployments still using the single file layout.
+
+    JSON and msgpack serializers keep the data independent of Python and python-telegram-bot
+    versions. They support None, bool, int, float, str, list, tuple and dict values (with any of
+    these as keys), which covers conversation states and plain user data. Data containing other
+    objects is stored with pickle, the serializer used is recorded in the blob header.
+    """
+    MAGIC = b'S3P'
+    VERSION = 1
+
+    SERIALIZERS = {'pickle': 0, 'json': 1, 'msgpack': 2}
+    COMPRESSIONS = {None: 0, 'zlib': 1, 'zstd': 2}
+
+    def __init__(self, serializer: str = 'pickle', compression: Optional[str] = None, level: int = 3):
+        """
+        Initializes the codec.
+        :param serializer: 'pickle', 'json' or 'msgpack' (requires msgpack package)
+        :param compression: None, 'zlib' or 'zstd' (requires zstandard package)
+        :param level: Compression level
+        """
+        if serializer not in self.SERIALIZERS:
+            raise ValueError(f"Unknown serializer {serializer}")
+
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}")
+
+        if serializer == 'msgpack' and msgpack is None:
+            raise ImportError("msgpack package is required for msgpack serializer")
+
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstandard package is required for zstd compression")
+
+        self.serializer = serializer
+        self.compression = compression
+        self.level = level
+
+    def encode(self, data: Any) -> bytes:
+        """
+        Encodes data into a blob.
+        """
+        serializer = self.serializer
+
+        try:
+            payload = self._serialize(serializer, data)
+        except TypeError:
+            serializer = 'pickle'
+            payload = self._serialize(serializer, data)
+
+        payload = self._compress(self.compression, payload)
+
+        header = self.MAGIC + bytes([
+            self.VERSION,
+            self.SERIALIZERS[serializer],
+            self.COMPRESSIONS[self.compression],
+        ])
+
+        return header + payload
+
+    def decode(self, blob: bytes) -> Any:
+        """
+        Decodes data from a blob.
+        """
+        if not blob.startswith(self.MAGIC):
+            return pickle.loads(blob)
+
+        header_size = len(self.MAGIC) + 3
+        version, serializer_id, compression_id = blob[len(self.MAGIC):header_size]
+
+        if version > self.VERSION:
+            raise ValueError(f"Unsupported persistence blob version {version}")
+
+        serializer = self._get_name(self.SERIALIZERS, serializer_id)
+        compression = self._get_name(self.COMPRESSIONS, compression_id)
+
+        payload = self._decompress(compression, blob[header_size:])
+
+        return self._deserialize(serializer, payload)
+
+    def _serialize(self, serializer: str, data: Any) -> bytes:
+        if serializer == 'json':
+            return json.dumps(_to_plain(data), ensure_ascii=False, separators=(',', ':')).encode('utf8')
+
+        if serializer == 'msgpack':
+            return msgpack.packb(_to_plain(data), use_bin_type=True)
+
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _deserialize(serializer: str, payload: bytes) -> Any:
+        if serializer == 'json':
+            return _from_plain(json.loads(payload))
+
+        if serializer == 'msgpack':
+            if msgpack is None:
+                raise ImportError("msgpack package is required to read msgpack persistence blobs")
+            return _from_plain(msgpack.unpackb(payload, raw=False, strict_map_key=False))
+
+        return pickle.loads(payload)
+
+    def _compress(self, compression: Optional[str], payload: bytes) -> bytes:
+        if compression == 'zlib':
+            return zlib.compress(payload, self.level)
+
+        if compression == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compress(payload)
+
+        return payload
+
+    @staticmethod
+    def _decompress(compression: Optional[str], payload: bytes) -> bytes:
+        if compression == 'zlib':
+            return zlib.decompress(payload)
+
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ImportError("zstandard package is required to read zstd persistence blobs")
+            return zstandard.ZstdDecompressor().decompress(payload)
+
+        return payload
+
+    @staticmethod
+    def _get_name(ids: dict, value: int):
+        for name, id_ in ids.items():
+            if id_ == value:
+                return name
+
+        raise ValueError(f"Unknown persistence blob encoding {value}")
+
+
+# Tags of the values which JSON and msgpack can not represent directly
+_TUPLE = '__tuple__'
+_ITEMS = '__items__'
+
+
+def _to_plain(value: Any) -> Any:
+    """
+    Converts a value into JSON compatible structure.
+    Tuples and dicts with non-string keys are stored as tagged lists.
+    """
+    value_type = type(value)
+
+    if value is None or value_type in (bool, int, float, str):
+        return value
+
+    if value_type is list:
+        return [_to_plain(item) for item in value]
+
+    if value_type is tuple:
+        return {_TUPLE: [_to_plain(item) for item in value]}
+
+    if value_type is dict:
+        if all(type(key) is str for key in value) and _TUPLE not in value and _ITEMS not in value:
+            return {key: _to_plain(item) for key, item in value.items()}
+
+        return {_ITEMS: [[_to_plain(key), _to_plain(item)] for key, item in value.items()]}
+
+    raise TypeError(f"Object of type {value_type.__name__} is not supported")
+
+
+def _from_plain(value: Any) -> Any:
+    """
+    Restores a value converted with _to_plain.
+    """
+    if isinstance(value, list):
+        return [_from_plain(item) for item in value]
+
+    if isinstance(value, dict):
+        if len(value) == 1 and _TUPLE in value:
+            return tuple(_from_plain(item) for item in value[_TUPLE])
+
+        if len(value) == 1 and _ITEMS in value:
+            return {_from_plain(key): _from_plain(item) for key, item in value[_ITEMS]}
+
+        return {key: _from_plain(item) for key, item in value.items()}
+
+    return value
@@ -1,32 +1,121 @@
-import requests
+import asyncio
+import random
+import time
+
+import httpx
+
+
+class RestClientError(Exception):
+    """
+    Analysis API request failed.
+    """
+
+    def __init__(self, message, retry_after=None):
+        """
+        :param retry_after: Seconds the API asked to wait before the next request, if it did.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RestClientError):
+    """
+    Analysis API is considered unavailable, the request was not sent.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker.
+    Opens after the number of consecutive failures and rejects calls for the reset timeout,
+    then lets a single trial call through: its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+
+        if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+
+        self.trial = True
+
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Ends the trial call without a result, e.g. when it was cancelled, so the next call is a trial one.
+        """
+        self.trial = False
 
 
 class RestClient:
     """
     Rest client class.
+    Requests are sent with a shared keep-alive connection pool, with timeouts,
+    retries with exponential backoff and a circuit breaker.
     """
 
-    def __init__(self, url, token):
+    def __init__(self, url, token, timeout=10, retries=3, backoff=0.5, failure_threshold=5, reset_timeout=30):
+        """
+        :param timeout: Timeout of a single request attempt, in seconds.
+        :param retries: Number of retries of a failed request.
+        :param backoff: Delay before the first retry, doubled for each next one, in seconds.
+        """
         self.url = url
         self.token = token
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 3))
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.client = None
 
-    def upload_file(self, filename, user_id):
+    def get_client(self):
         """
-        Sends file to analysis.
+        Returns the HTTP client, it is created on first use to be bound to the running event loop.
         """
-        url = self.url + 'files/'
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            )
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.token
-        }
+        return self.client
 
+    async def upload_file(self, filename, user_id):
+        """
+        Sends file to analysis.
+        """
         data = {
             "manager_id": str(user_id),
             "file_name": filename,
         }
 
-        response = requests.post(url, headers=headers, json=data).json()
+        # The request creates an analysis, so it is retried only if it was not sent
+        try:
+            response = await self.post('files/', data, idempotent=False)
+        except RestClientError as e:
+            print(f"Error: '{e}' occurred")
+            return None
 
         if not response:
             return None
@@ -38,21 +127,94 @@ class RestClient:
 
         return file_id
 
-    def get_result(self, operation_id):
+    async def get_result(self, operation_id):
         """
         Checks for analysis result by file id.
+        Returns True if the result is ready and False if not.
+        Raises RestClientError if the check failed or was throttled, with the Retry-After pause if any.
+        """
+        data = {
+            "file_id": operation_id,
+        }
+
+        response = await self.send('result/', data)
+
+        if response.status_code == 429:
+            raise RestClientError('result/: status 429', get_retry_after(response))
+
+        return response.status_code == 200
+
+    async def post(self, path, data, idempotent=True):
+        """
+        Sends a POST request and returns the response JSON.
+        """
+        response = await self.send(path, data, idempotent)
+
+        try:
+            return response.json()
+        except ValueError:
+            raise RestClientError(f'{path}: invalid response')
+
+    async def send(self, path, data, idempotent=True):
+        """
+        Sends a POST request and returns the response with status below 500.
+        Connection errors are retried, timeouts and 5xx responses are retried for idempotent requests only.
         """
-        url = self.url + 'result/'
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'{path}: circuit is open')
+
+        trial = self.breaker.trial
+
+        try:
+            return await self._send(path, data, idempotent)
+        finally:
+            # A trial call which ended without success or failure must not keep the circuit open
+            if trial:
+                self.breaker.release()
 
+    async def _send(self, path, data, idempotent):
         headers = {
             'Content-Type': 'application/json',
             'Authorization': 'Bearer ' + self.token
         }
 
-        data = {
-            "file_id": operation_id,
-        }
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.get_client().post(self.url + path, headers=headers, json=data)
+
+                if response.status_code < 500:
+                    self.breaker.success()
 
-        response = requests.post(url, headers=headers, json=data).json()
+                    return response
 
-        return response
+                error = RestClientError(f'{path}: status {response.status_code}', get_retry_after(response))
+                retryable = idempotent
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                error = RestClientError(f'{path}: {e!r}')
+                retryable = True
+            except httpx.TransportError as e:
+                error = RestClientError(f'{path}: {e!r}')
+                retryable = idempotent
+            except httpx.HTTPError as e:
+                # Decoding errors and redirect loops are not fixed by a retry
+                error = RestClientError(f'{path}: {e!r}')
+                retryable = False
+
+            if not retryable or attempt == self.retries:
+                break
+
+            await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1))
+
+        self.breaker.failure()
+
+        raise error
+
+
+def get_retry_after(response):
+    """
+    Returns the Retry-After pause of the response in seconds or None.
+    """
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
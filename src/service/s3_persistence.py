@@ -1,17 +1,60 @@
+import asyncio
 import os
 import pickle
+import time
+import zlib
 from copy import deepcopy
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, Union, cast, overload
+from typing import Any, Dict, Optional, Set, Tuple, Union, cast, overload
+from urllib.parse import quote
 
 import boto3
+from botocore.exceptions import ClientError
 from telegram._utils.types import FilePathInput
 from telegram.ext import BasePersistence, PersistenceInput
 from telegram.ext._contexttypes import ContextTypes
 from telegram.ext._utils.types import BD, CD, UD, CDCData, ConversationDict, ConversationKey
 
+from .executor import run_blocking
+from .persistence_codec import PersistenceCodec
+
+# Result of a revalidated load of an object which was not modified since it was loaded
+NOT_MODIFIED = object()
+
 
 class S3Persistence(BasePersistence[UD, CD, BD]):
+    """
+    Persistence storing the bot data as objects in S3 bucket.
+    Objects are encoded with ``codec``, pickle without compression by default.
+
+    With ``sharded`` set, each user_data and chat_data entry is stored in its own object
+    (``<filepath>/user_data/<user_id>``), which is loaded on first access of the user or chat
+    and written only when that entry changed. Conversations of a handler are split by key hash
+    into ``conversation_buckets`` objects (``<filepath>/conversations/<name>/<bucket>``),
+    only the buckets with changed states are written. Data of the single file layout, stored
+    at ``<filepath>``, is moved to this layout on first start, see :meth:`_migrate_single_file`.
+
+    Stored data is handed to the application without a deep copy. An entry is copied only when
+    it is accessed for the first time in :meth:`refresh_user_data`, :meth:`refresh_chat_data`
+    or :meth:`refresh_bot_data`, so the application changes its own copy and the changes can be
+    detected on update.
+
+    Changes are tracked and written in one go: on :meth:`flush` if ``on_flush`` is set,
+    otherwise once ``max_write_delay`` seconds passed since the first unsaved change.
+    The delayed write is scheduled on the event loop, so it happens only while the loop runs:
+    in a function frozen between invocations call :meth:`flush` or set ``on_flush``.
+
+    :meth:`reload` and the entry loads following it request the objects already loaded or written
+    by this instance with ``If-None-Match`` of that version, so unchanged objects are neither
+    downloaded nor decoded again. With ``cache_dir`` set, downloaded objects are also cached
+    on local disk along with their ETags, for the objects not loaded by this instance yet.
+    S3 requests are made in the I/O thread pool, so they do not block the event loop.
+    The data is serialized in the event loop thread before the upload.
+
+    With ``conditional_writes`` set, sharded objects are written with ``If-Match`` of the
+    loaded version. If another instance changed a conversations bucket meanwhile,
+    the states changed by this instance are applied on top of the stored ones.
+    """
     __slots__ = (
         "bot_data",
         "callback_data",
@@ -21,8 +64,26 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         "filepath",
         "on_flush",
         "single_file",
+        "sharded",
+        "conversation_buckets",
         "user_data",
-        "s3"
+        "s3",
+        "max_write_delay",
+        "cache_dir",
+        "conditional_writes",
+        "codec",
+        "_etags",
+        "_loaded_user_ids",
+        "_loaded_chat_ids",
+        "_loaded_bot_data",
+        "_changed",
+        "_changed_keys",
+        "_changed_since",
+        "_save_lock",
+        "_save_timer",
+        "_save_task",
+        "_migrated",
+        "_migrate_lock",
     )
 
     @overload
@@ -33,6 +94,12 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             single_file: bool = True,
             on_flush: bool = False,
             update_interval: float = 60,
+            sharded: bool = False,
+            conversation_buckets: int = 16,
+            max_write_delay: float = 0,
+            cache_dir: Optional[FilePathInput] = None,
+            conditional_writes: bool = False,
+            codec: Optional[PersistenceCodec] = None,
     ):
         ...
 
@@ -45,6 +112,12 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             on_flush: bool = False,
             update_interval: float = 60,
             context_types: Optional[ContextTypes[Any, UD, CD, BD]] = None,
+            sharded: bool = False,
+            conversation_buckets: int = 16,
+            max_write_delay: float = 0,
+            cache_dir: Optional[FilePathInput] = None,
+            conditional_writes: bool = False,
+            codec: Optional[PersistenceCodec] = None,
     ):
         ...
 
@@ -56,11 +129,26 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             on_flush: bool = False,
             update_interval: float = 60,
             context_types: Optional[ContextTypes[Any, UD, CD, BD]] = None,
+            sharded: bool = False,
+            conversation_buckets: int = 16,
+            max_write_delay: float = 0,
+            cache_dir: Optional[FilePathInput] = None,
+            conditional_writes: bool = False,
+            codec: Optional[PersistenceCodec] = None,
     ):
         super().__init__(store_data=store_data, update_interval=update_interval)
         self.filepath: Path = Path(filepath)
-        self.single_file: Optional[bool] = single_file
+        # bot_data and callback_data are stored in separate files in sharded layout
+        self.single_file: Optional[bool] = single_file and not sharded
         self.on_flush: Optional[bool] = on_flush
+        self.sharded: bool = sharded
+        self.conversation_buckets: int = conversation_buckets
+        self.max_write_delay: float = max_write_delay
+        self.cache_dir: Optional[Path] = Path(cache_dir) if cache_dir is not None else None
+        self.conditional_writes: bool = conditional_writes
+        self.codec: PersistenceCodec = codec or PersistenceCodec()
+        # ETags of the object versions last loaded or written by this instance
+        self._etags: Dict[str, str] = {}
         self.user_data: Optional[Dict[int, UD]] = None
         self.chat_data: Optional[Dict[int, CD]] = None
         self.bot_data: Optional[BD] = None
@@ -69,6 +157,20 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         self.context_types: ContextTypes[Any, UD, CD, BD] = cast(
             ContextTypes[Any, UD, CD, BD], context_types or ContextTypes()
         )
+        # Keys of the entries which were loaded or copied on first access
+        self._loaded_user_ids: Set[int] = set()
+        self._loaded_chat_ids: Set[int] = set()
+        self._loaded_bot_data: bool = False
+        # Names of the changed data and, in sharded layout, the changed keys of each of them
+        self._changed: Set[str] = set()
+        self._changed_keys: Dict[str, Set[Any]] = {"user_data": set(), "chat_data": set(), "conversations": set()}
+        self._changed_since: Optional[float] = None
+        self._save_lock = asyncio.Lock()
+        # Scheduled save of the changes made within max_write_delay
+        self._save_timer: Optional[asyncio.TimerHandle] = None
+        self._save_task: Optional[asyncio.Task] = None
+        self._migrated: bool = False
+        self._migrate_lock = asyncio.Lock()
         """
         Initializes the S3 object.
         """
@@ -78,11 +180,10 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             endpoint_url='https://storage.yandexcloud.net'
         )
 
-    def _load_singlefile(self) -> None:
+    async def _load_singlefile(self) -> None:
         try:
             try:
-                get_object_response = self.s3.get_object(Bucket=os.getenv('S3_BUCKET'), Key=self.filepath.as_posix())
-                data = pickle.loads(get_object_response['Body'].read())
+                data = self.codec.decode(await run_blocking(self._get_object, self.filepath))
             except Exception as exc:
                 data = {}
 
@@ -104,18 +205,22 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         except Exception as exc:
             raise TypeError(f"Something went wrong unpickling {self.filepath.name}") from exc
 
-    def _load_file(self, filepath: Path) -> Any:
+    async def _load_file(self, filepath: Path, revalidate: bool = False) -> Any:
+        """Returns the decoded object, None if it does not exist or ``NOT_MODIFIED``
+        if ``revalidate`` is set and the object was not modified since it was loaded."""
         try:
-            get_object_response = self.s3.get_object(Bucket=os.getenv('S3_BUCKET'), Key=filepath.as_posix())
-            return pickle.loads(get_object_response['Body'].read())
-        except OSError:
+            body = await run_blocking(self._get_object, filepath, revalidate)
+            if body is None:
+                return NOT_MODIFIED
+            return self.codec.decode(body)
+        except (OSError, self.s3.exceptions.NoSuchKey):
             return None
         except pickle.UnpicklingError as exc:
             raise TypeError(f"File {filepath.name} does not contain valid pickle data") from exc
         except Exception as exc:
             raise TypeError(f"Something went wrong unpickling {filepath.name}") from exc
 
-    def _dump_singlefile(self) -> None:
+    async def _dump_singlefile(self) -> None:
         data = {
             "conversations": self.conversations,
             "user_data": self.user_data,
@@ -123,80 +228,378 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             "bot_data": self.bot_data,
             "callback_data": self.callback_data,
         }
-        pickle_byte_obj = pickle.dumps(data)
-        self.s3.put_object(Bucket=os.getenv('S3_BUCKET'), Key=self.filepath.as_posix(),
-                           Body=pickle_byte_obj, StorageClass='COLD')
+        await run_blocking(self._put_object, self.filepath, self.codec.encode(data))
+
+    async def _dump_file(self, filepath: Path, data: object, conditional: bool = False) -> None:
+        await run_blocking(self._put_object, filepath, self.codec.encode(data), conditional)
 
-    def _dump_file(self, filepath: Path, data: object) -> None:
-        pickle_byte_obj = pickle.dumps(data)
-        self.s3.put_object(Bucket=os.getenv('S3_BUCKET'), Key=filepath.as_posix(),
-                           Body=pickle_byte_obj, StorageClass='COLD')
+    async def _delete_file(self, filepath: Path) -> None:
+        await run_blocking(self._delete_object, filepath)
+
+    def _delete_object(self, filepath: Path) -> None:
+        self.s3.delete_object(Bucket=os.getenv('S3_BUCKET'), Key=filepath.as_posix())
+        self._etags.pop(filepath.as_posix(), None)
+
+    def _get_object(self, filepath: Path, revalidate: bool = False) -> Optional[bytes]:
+        """Downloads the object body. With ``revalidate`` set, an object loaded or written by this
+        instance is requested with ``If-None-Match`` of that version and None is returned when it
+        is not modified, so the data in memory is kept. Otherwise an object cached on disk is
+        requested with ``If-None-Match`` and the cached body is returned when it is not modified."""
+        key = filepath.as_posix()
+        if revalidate and key in self._etags:
+            etag, cached_body = self._etags[key], None
+        else:
+            etag, cached_body = self._read_cache(key)
+        params = {"Bucket": os.getenv('S3_BUCKET'), "Key": key}
+        if etag is not None:
+            params["IfNoneMatch"] = etag
+        try:
+            get_object_response = self.s3.get_object(**params)
+        except ClientError as exc:
+            if etag is None or exc.response["Error"]["Code"] not in ("304", "NotModified"):
+                raise
+            self._etags[key] = etag
+            return cached_body
+        body = get_object_response["Body"].read()
+        etag = get_object_response.get("ETag")
+        if etag is None:
+            # The object can not be revalidated without an ETag, so it is downloaded every time
+            self._etags.pop(key, None)
+        else:
+            self._etags[key] = etag
+            self._write_cache(key, etag, body)
+        return body
+
+    def _put_object(self, filepath: Path, body: bytes, conditional: bool = False, create: bool = False) -> None:
+        """Uploads the object body. If ``conditional`` and :attr:`conditional_writes` are set,
+        the upload fails with :class:`ClientError` when the object was changed since it was
+        loaded or created since it was found missing. If ``create`` is set, it fails when
+        the object exists."""
+        key = filepath.as_posix()
+        params = {"Bucket": os.getenv('S3_BUCKET'), "Key": key, "Body": body, "StorageClass": 'COLD'}
+        if create:
+            params["IfNoneMatch"] = "*"
+        elif conditional and self.conditional_writes:
+            if key in self._etags:
+                params["IfMatch"] = self._etags[key]
+            else:
+                params["IfNoneMatch"] = "*"
+        put_object_response = self.s3.put_object(**params)
+        self._etags[key] = put_object_response["ETag"]
+        self._write_cache(key, put_object_response["ETag"], body)
+
+    def _cache_path(self, key: str) -> Path:
+        return cast(Path, self.cache_dir) / quote(key, safe="")
+
+    def _read_cache(self, key: str) -> Tuple[Optional[str], Optional[bytes]]:
+        """Returns the ETag and the body of the cached object or ``(None, None)``."""
+        if self.cache_dir is None:
+            return None, None
+        path = self._cache_path(key)
+        try:
+            etag = Path(f"{path}.etag").read_text()
+            return etag, path.read_bytes()
+        except OSError:
+            return None, None
+
+    def _write_cache(self, key: str, etag: str, body: bytes) -> None:
+        if self.cache_dir is None:
+            return
+        path = self._cache_path(key)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # The body is written first, so a stale ETag never points to a newer body
+            Path(f"{path}.etag").unlink(missing_ok=True)
+            path.write_bytes(body)
+            Path(f"{path}.etag").write_text(etag)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _is_conflict(exc: ClientError) -> bool:
+        return exc.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+
+    def _shard_path(self, kind: str, key: object) -> Path:
+        return Path(f"{self.filepath}/{kind}/{key}")
+
+    async def _dump_shard(self, kind: str, data: Dict[Any, Any], key: object) -> None:
+        """Saves a single entry of user_data or chat_data to its own object
+        or deletes the object if the entry was dropped."""
+        filepath = self._shard_path(kind, key)
+        if key not in data:
+            await self._delete_file(filepath)
+            return
+        try:
+            await self._dump_file(filepath, data[key], conditional=True)
+        except ClientError as exc:
+            if not self._is_conflict(exc):
+                raise
+            # The same user or chat was processed by another instance, the latest update wins
+            self._etags.pop(filepath.as_posix(), None)
+            await self._dump_file(filepath, data[key])
+
+    async def _migrate_single_file(self) -> None:
+        """Moves the data of the single file layout to the sharded one. Runs once per instance:
+        if the ``<filepath>`` object exists, its entries are written to their own objects and
+        the object is moved to ``<filepath>_migrated``. Objects which exist already, written by
+        another instance migrating at the same time or after the migration, are not overwritten."""
+        if self._migrated:
+            return
+        async with self._migrate_lock:
+            if self._migrated:
+                return
+            data = await self._load_file(self.filepath)
+            if data:
+                writes = []
+                for kind in ("user_data", "chat_data"):
+                    for key, entry in (data.get(kind) or {}).items():
+                        if entry:
+                            writes.append(self._migrate_object(self._shard_path(kind, key), entry))
+                for name, conversations in (data.get("conversations") or {}).items():
+                    buckets: Dict[int, Dict[Any, Any]] = {}
+                    for key, state in conversations.items():
+                        if state is not None:
+                            buckets.setdefault(self._get_bucket(key), {})[key] = state
+                    for bucket, states in buckets.items():
+                        writes.append(self._migrate_object(self._bucket_path(name, bucket), states))
+                for kind in ("bot_data", "callback_data"):
+                    if data.get(kind):
+                        writes.append(self._migrate_object(Path(f"{self.filepath}_{kind}"), data[kind]))
+                await asyncio.gather(*writes)
+                # Kept for a rollback to the single file layout
+                await run_blocking(self._copy_object, self.filepath, Path(f"{self.filepath}_migrated"))
+            if data is not None:
+                await self._delete_file(self.filepath)
+            self._migrated = True
+
+    async def _migrate_object(self, filepath: Path, data: object) -> None:
+        try:
+            await run_blocking(self._put_object, filepath, self.codec.encode(data), create=True)
+        except ClientError as exc:
+            if not self._is_conflict(exc):
+                raise
+        # The entry is loaded on access as usual, not revalidated against the version written here
+        self._etags.pop(filepath.as_posix(), None)
+
+    def _copy_object(self, source: Path, filepath: Path) -> None:
+        bucket = os.getenv('S3_BUCKET')
+        try:
+            self.s3.copy_object(Bucket=bucket, Key=filepath.as_posix(),
+                                CopySource={"Bucket": bucket, "Key": source.as_posix()})
+        except ClientError as exc:
+            # Moved by another instance migrating at the same time
+            if exc.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+
+    def _get_bucket(self, key: ConversationKey) -> int:
+        # Stable across processes, unlike hash() of strings
+        return zlib.crc32(repr(key).encode()) % self.conversation_buckets
+
+    def _bucket_path(self, name: str, bucket: int) -> Path:
+        return Path(f"{self.filepath}/conversations/{name}/{bucket}")
+
+    async def _load_conversations(self, name: str) -> Dict[Any, Any]:
+        """Loads all buckets of the conversations of the given handler."""
+        buckets = await asyncio.gather(
+            *(self._load_file(self._bucket_path(name, bucket)) for bucket in range(self.conversation_buckets))
+        )
+        conversations: Dict[Any, Any] = {}
+        for data in buckets:
+            conversations.update(data or {})
+        return conversations
+
+    async def _dump_conversations(self, name: str, bucket: int, keys: Set[ConversationKey]) -> None:
+        """Saves a bucket of conversations of the given handler. If it was changed by another
+        instance, the stored states of all keys except the given ones are taken over before retrying."""
+        filepath = self._bucket_path(name, bucket)
+        for _ in range(3):
+            conversations = cast(Dict[str, Dict[Any, Any]], self.conversations)[name]
+            data = {
+                key: state for key, state in conversations.items()
+                if state is not None and self._get_bucket(key) == bucket
+            }
+            try:
+                await self._dump_file(filepath, data, conditional=True)
+                return
+            except ClientError as exc:
+                if not self._is_conflict(exc):
+                    raise
+            self._merge_conversations(name, bucket, await self._load_file(filepath) or {}, keys)
+        raise RuntimeError(f"Could not save conversations {name}, they are changed concurrently")
+
+    def _merge_conversations(self, name: str, bucket: int, stored: Dict[Any, Any], keep: Set[Any]) -> None:
+        """Replaces the states of the bucket of the given handler with the stored ones,
+        except the states of the given keys."""
+        conversations = cast(Dict[str, Dict[Any, Any]], self.conversations).setdefault(name, {})
+        for key in [key for key in conversations if key not in keep and self._get_bucket(key) == bucket]:
+            del conversations[key]
+        conversations.update({key: state for key, state in stored.items() if key not in keep})
+
+    async def _mark_changed(self, kind: str, key: object = None) -> None:
+        """Marks the data as changed and saves it unless :attr:`on_flush` is set.
+        If :attr:`max_write_delay` has not passed since the first unsaved change,
+        the save is scheduled for when it passes."""
+        self._changed.add(kind)
+        if self.sharded and key is not None:
+            self._changed_keys[kind].add(key)
+        if self._changed_since is None:
+            self._changed_since = time.monotonic()
+        if self.on_flush:
+            return
+        if time.monotonic() - self._changed_since >= self.max_write_delay:
+            await self._save()
+        else:
+            self._schedule_save()
+
+    def _schedule_save(self) -> None:
+        if self._save_timer is not None or self._changed_since is None:
+            return
+        delay = max(0.0, self._changed_since + self.max_write_delay - time.monotonic())
+        self._save_timer = asyncio.get_running_loop().call_later(delay, self._start_delayed_save)
+
+    def _start_delayed_save(self) -> None:
+        self._save_timer = None
+        self._save_task = asyncio.ensure_future(self._save_delayed())
+
+    async def _save_delayed(self) -> None:
+        try:
+            await self._save()
+        except Exception as e:
+            print(f"Error: '{e}' occurred")
+
+    async def _save(self) -> None:
+        """Saves the changed data to pickle file(s). Independent objects are uploaded concurrently."""
+        async with self._save_lock:
+            if not self._changed:
+                return
+            changed, self._changed = self._changed, set()
+            changed_keys = self._changed_keys
+            self._changed_keys = {"user_data": set(), "chat_data": set(), "conversations": set()}
+            self._changed_since = None
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+
+            dumps = []
+            if self.sharded:
+                for user_id in changed_keys["user_data"]:
+                    dumps.append(self._dump_shard("user_data", self.user_data or {}, user_id))
+                for chat_id in changed_keys["chat_data"]:
+                    dumps.append(self._dump_shard("chat_data", self.chat_data or {}, chat_id))
+                changed_buckets: Dict[Tuple[str, int], Set[ConversationKey]] = {}
+                for name, key in changed_keys["conversations"]:
+                    changed_buckets.setdefault((name, self._get_bucket(key)), set()).add(key)
+                for (name, bucket), keys in changed_buckets.items():
+                    dumps.append(self._dump_conversations(name, bucket, keys))
+                if "bot_data" in changed:
+                    dumps.append(self._dump_file(Path(f"{self.filepath}_bot_data"), self.bot_data))
+                if "callback_data" in changed:
+                    dumps.append(self._dump_file(Path(f"{self.filepath}_callback_data"), self.callback_data))
+            elif self.single_file:
+                dumps.append(self._dump_singlefile())
+            else:
+                for kind in changed:
+                    dumps.append(self._dump_file(Path(f"{self.filepath}_{kind}"), getattr(self, kind)))
+            try:
+                await asyncio.gather(*dumps)
+            except Exception:
+                # Keep the data marked as changed to save it on the next attempt
+                self._changed |= changed
+                for kind, keys in changed_keys.items():
+                    self._changed_keys[kind] |= keys
+                if self._changed_since is None:
+                    self._changed_since = time.monotonic()
+                if not self.on_flush and self.max_write_delay > 0:
+                    # Retried after the delay, unless a next change or flush() comes earlier
+                    self._schedule_save()
+                raise
 
     async def get_user_data(self) -> Dict[int, UD]:
-        """Returns the user_data from the pickle file if it exists or an empty :obj:`dict`."""
+        """Returns the user_data from the pickle file if it exists or an empty :obj:`dict`.
+        If :attr:`sharded` is set, the entries are loaded later in :meth:`refresh_user_data`."""
+        if self.sharded:
+            await self._migrate_single_file()
         if self.user_data:
             pass
+        elif self.sharded:
+            self.user_data = {}
         elif not self.single_file:
-            data = self._load_file(Path(f"{self.filepath}_user_data"))
+            data = await self._load_file(Path(f"{self.filepath}_user_data"))
             if not data:
                 data = {}
             self.user_data = data
         else:
-            self._load_singlefile()
-        return deepcopy(self.user_data)  # type: ignore[arg-type]
+            await self._load_singlefile()
+        return self.user_data.copy()  # type: ignore[union-attr]
 
     async def get_chat_data(self) -> Dict[int, CD]:
-        """Returns the chat_data from the pickle file if it exists or an empty :obj:`dict`."""
+        """Returns the chat_data from the pickle file if it exists or an empty :obj:`dict`.
+        If :attr:`sharded` is set, the entries are loaded later in :meth:`refresh_chat_data`."""
+        if self.sharded:
+            await self._migrate_single_file()
         if self.chat_data:
             pass
+        elif self.sharded:
+            self.chat_data = {}
         elif not self.single_file:
-            data = self._load_file(Path(f"{self.filepath}_chat_data"))
+            data = await self._load_file(Path(f"{self.filepath}_chat_data"))
             if not data:
                 data = {}
             self.chat_data = data
         else:
-            self._load_singlefile()
-        return deepcopy(self.chat_data)  # type: ignore[arg-type]
+            await self._load_singlefile()
+        return self.chat_data.copy()  # type: ignore[union-attr]
 
     async def get_bot_data(self) -> BD:
         """Returns the bot_data from the pickle file if it exists or an empty object of type"""
+        if self.sharded:
+            await self._migrate_single_file()
         if self.bot_data:
             pass
         elif not self.single_file:
-            data = self._load_file(Path(f"{self.filepath}_bot_data"))
+            data = await self._load_file(Path(f"{self.filepath}_bot_data"))
             if not data:
                 data = self.context_types.bot_data()
             self.bot_data = data
         else:
-            self._load_singlefile()
-        return deepcopy(self.bot_data)  # type: ignore[return-value]
+            await self._load_singlefile()
+        return self.bot_data  # type: ignore[return-value]
 
     async def get_callback_data(self) -> Optional[CDCData]:
         """Returns the callback data from the pickle file if it exists or :obj:`None`."""
+        if self.sharded:
+            await self._migrate_single_file()
         if self.callback_data:
             pass
         elif not self.single_file:
-            data = self._load_file(Path(f"{self.filepath}_callback_data"))
+            data = await self._load_file(Path(f"{self.filepath}_callback_data"))
             if not data:
                 data = None
             self.callback_data = data
         else:
-            self._load_singlefile()
+            await self._load_singlefile()
         if self.callback_data is None:
             return None
-        return deepcopy(self.callback_data)
+        # The callback data cache copies the entries into its own structures on load
+        return self.callback_data
 
     async def get_conversations(self, name: str) -> ConversationDict:
         """Returns the conversations from the pickle file if it exists or an empty dict."""
-        if self.conversations:
+        if self.sharded:
+            await self._migrate_single_file()
+            if self.conversations is None:
+                self.conversations = {}
+            if name not in self.conversations:
+                self.conversations[name] = await self._load_conversations(name)
+        elif self.conversations:
             pass
         elif not self.single_file:
-            data = self._load_file(Path(f"{self.filepath}_conversations"))
+            data = await self._load_file(Path(f"{self.filepath}_conversations"))
             if not data:
                 data = {name: {}}
             self.conversations = data
         else:
-            self._load_singlefile()
+            await self._load_singlefile()
         return self.conversations.get(name, {}).copy()  # type: ignore[union-attr]
 
     async def update_conversation(
@@ -209,11 +612,7 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         if self.conversations.setdefault(name, {}).get(key) == new_state:
             return
         self.conversations[name][key] = new_state
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_conversations"), self.conversations)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("conversations", (name, key))
 
     async def update_user_data(self, user_id: int, data: UD) -> None:
         """Will update the user_data and depending on :attr:`on_flush` save the pickle file."""
@@ -222,11 +621,7 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         if self.user_data.get(user_id) == data:
             return
         self.user_data[user_id] = data
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_user_data"), self.user_data)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("user_data", user_id)
 
     async def update_chat_data(self, chat_id: int, data: CD) -> None:
         """Will update the chat_data and depending on :attr:`on_flush` save the pickle file."""
@@ -235,22 +630,14 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         if self.chat_data.get(chat_id) == data:
             return
         self.chat_data[chat_id] = data
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_chat_data"), self.chat_data)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("chat_data", chat_id)
 
     async def update_bot_data(self, data: BD) -> None:
         """Will update the bot_data and depending on :attr:`on_flush` save the pickle file. """
         if self.bot_data == data:
             return
         self.bot_data = data
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_bot_data"), self.bot_data)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("bot_data")
 
     async def update_callback_data(self, data: CDCData) -> None:
         """Will update the callback_data (if changed) and depending on 
@@ -259,11 +646,7 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
         if self.callback_data == data:
             return
         self.callback_data = data
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_callback_data"), self.callback_data)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("callback_data")
 
     async def drop_chat_data(self, chat_id: int) -> None:
         """Will delete the specified key from the ``chat_data`` and depending on
@@ -272,11 +655,7 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             return
         self.chat_data.pop(chat_id, None)
 
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_chat_data"), self.chat_data)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("chat_data", chat_id)
 
     async def drop_user_data(self, user_id: int) -> None:
         """Will delete the specified key from the ``user_data`` and depending on
@@ -285,40 +664,111 @@ class S3Persistence(BasePersistence[UD, CD, BD]):
             return
         self.user_data.pop(user_id, None)
 
-        if not self.on_flush:
-            if not self.single_file:
-                self._dump_file(Path(f"{self.filepath}_user_data"), self.user_data)
-            else:
-                self._dump_singlefile()
+        await self._mark_changed("user_data", user_id)
 
     async def refresh_user_data(self, user_id: int, user_data: UD) -> None:
-        pass
+        """Copies the user_data of the given user on first access or loads it
+        if :attr:`sharded` is set. After :meth:`reload` the stored entry replaces
+        the one of the application."""
+        if user_id in self._loaded_user_ids:
+            return
+        self._loaded_user_ids.add(user_id)
+        if not self.sharded:
+            self._refresh_entry(self.user_data, user_id, user_data)
+            return
+        if user_id in self._changed_keys["user_data"]:
+            # Changes of this instance are newer than the stored entry
+            return
+        data = await self._load_file(self._shard_path("user_data", user_id), revalidate=True)
+        if data is NOT_MODIFIED or not data:
+            # Not modified entries are the same in memory and in the application
+            return
+        if self.user_data is None:
+            self.user_data = {}
+        self.user_data[user_id] = data
+        _replace_entry(user_data, deepcopy(data))
 
     async def refresh_chat_data(self, chat_id: int, chat_data: CD) -> None:
-        pass
+        """Copies the chat_data of the given chat on first access or loads it
+        if :attr:`sharded` is set. After :meth:`reload` the stored entry replaces
+        the one of the application."""
+        if chat_id in self._loaded_chat_ids:
+            return
+        self._loaded_chat_ids.add(chat_id)
+        if not self.sharded:
+            self._refresh_entry(self.chat_data, chat_id, chat_data)
+            return
+        if chat_id in self._changed_keys["chat_data"]:
+            # Changes of this instance are newer than the stored entry
+            return
+        data = await self._load_file(self._shard_path("chat_data", chat_id), revalidate=True)
+        if data is NOT_MODIFIED or not data:
+            # Not modified entries are the same in memory and in the application
+            return
+        if self.chat_data is None:
+            self.chat_data = {}
+        self.chat_data[chat_id] = data
+        _replace_entry(chat_data, deepcopy(data))
+
+    @staticmethod
+    def _refresh_entry(data: Optional[Dict[int, Any]], key: int, entry: Any) -> None:
+        if not data or key not in data:
+            return
+        if data[key] is entry:
+            # The application got the stored entry itself on initialize
+            data[key] = deepcopy(entry)
+        else:
+            _replace_entry(entry, deepcopy(data[key]))
 
     async def refresh_bot_data(self, bot_data: BD) -> None:
-        pass
+        """Copies the bot_data on first access."""
+        if self._loaded_bot_data:
+            return
+        self._loaded_bot_data = True
+        if self.bot_data is bot_data:
+            self.bot_data = deepcopy(bot_data)
+
+    async def reload(self, conversation_keys: Dict[str, Set[ConversationKey]]) -> None:
+        """Prepares the persistence of an application reused by the next update(s), as other
+        instances may have changed the data meanwhile. user_data and chat_data entries are loaded
+        again on their next access, the conversation buckets of the given keys are loaded again.
+        Changes of this instance which are not saved yet are kept. bot_data and callback_data
+        are not reloaded."""
+        self._loaded_user_ids.clear()
+        self._loaded_chat_ids.clear()
+        if not self.sharded:
+            if self._changed:
+                return
+            # All entries are stored in one or a few objects, which are loaded entirely
+            self.user_data = self.chat_data = self.conversations = None
+            await self.get_user_data()
+            await self.get_chat_data()
+            for name in conversation_keys:
+                await self.get_conversations(name)
+            return
+        if self.conversations is None:
+            self.conversations = {}
+        buckets = list({
+            (name, self._get_bucket(key))
+            for name, keys in conversation_keys.items() if name in self.conversations
+            for key in keys
+        })
+        stored = await asyncio.gather(
+            *(self._load_file(self._bucket_path(name, bucket), revalidate=True) for name, bucket in buckets)
+        )
+        pending = self._changed_keys["conversations"]
+        for (name, bucket), data in zip(buckets, stored):
+            if data is NOT_MODIFIED:
+                continue
+            keep = {key for changed_name, key in pending if changed_name == name}
+            self._merge_conversations(name, bucket, data or {}, keep)
 
     async def flush(self) -> None:
-        """Will save all data in memory to pickle file(s)."""
-        if self.single_file:
-            if (
-                    self.user_data
-                    or self.chat_data
-                    or self.bot_data
-                    or self.callback_data
-                    or self.conversations
-            ):
-                self._dump_singlefile()
-        else:
-            if self.user_data:
-                self._dump_file(Path(f"{self.filepath}_user_data"), self.user_data)
-            if self.chat_data:
-                self._dump_file(Path(f"{self.filepath}_chat_data"), self.chat_data)
-            if self.bot_data:
-                self._dump_file(Path(f"{self.filepath}_bot_data"), self.bot_data)
-            if self.callback_data:
-                self._dump_file(Path(f"{self.filepath}_callback_data"), self.callback_data)
-            if self.conversations:
-                self._dump_file(Path(f"{self.filepath}_conversations"), self.conversations)
+        """Will save all changed data in memory to pickle file(s)."""
+        await self._save()
+
+
+def _replace_entry(entry: Any, data: Dict[Any, Any]) -> None:
+    """Replaces the content of the user_data or chat_data entry of the application."""
+    cast(Dict[Any, Any], entry).clear()
+    cast(Dict[Any, Any], entry).update(data)
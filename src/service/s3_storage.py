@@ -1,38 +1,202 @@
+import mimetypes
 import os
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from .storage import Storage
 
+MB = 1024 * 1024
+
+# Clients shared by storages with the same credentials, by access key.
+# A client is thread-safe and keeps a pool of connections, so they stay open between invocations.
+_clients = {}
+
+# Pool uploading parts of the streamed files
+_part_executor = ThreadPoolExecutor(max_workers=int(os.getenv('S3_PART_THREADS', 16)), thread_name_prefix='s3-part')
+
+
+def get_client(credentials=None, max_connections=10):
+    """
+    Returns the S3 client for the credentials.
+    """
+    key = credentials['access_key'] if credentials is not None else None
+
+    if key in _clients:
+        return _clients[key]
+
+    session = boto3.session.Session()
+
+    session_params = {
+        "service_name": 's3',
+        "endpoint_url": 'https://storage.yandexcloud.net',
+        "config": Config(max_pool_connections=max_connections, tcp_keepalive=True,
+                         retries={'max_attempts': 3, 'mode': 'standard'}),
+    }
+
+    if credentials is not None:
+        session_params['aws_access_key_id'] = credentials['access_key']
+        session_params['aws_secret_access_key'] = credentials['secret_key']
+        session_params['region_name'] = credentials['region_name']
+
+    _clients[key] = session.client(**session_params)
+
+    return _clients[key]
+
+
+def get_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
 
 class S3Storage(Storage):
     """
     S3 storage service class.
     """
 
-    def __init__(self, bucket, credentials=None):
+    def __init__(self, bucket, credentials=None, part_size=8 * MB, concurrency=4):
         """
         Initializes the S3 object.
+        :param part_size: Part size of multipart uploads, files smaller than a part are uploaded with a single request.
+        :param concurrency: Number of parts of a file uploaded at the same time.
         """
         self.bucket = bucket
         self.credentials = credentials
+        self.part_size = max(part_size, S3Upload.MIN_PART_SIZE)
+        self.concurrency = concurrency
 
-        session = boto3.session.Session()
+        self.s3 = get_client(credentials, max_connections=max(10, concurrency * 2))
 
-        session_params = {
-            "service_name": 's3',
-            "endpoint_url": 'https://storage.yandexcloud.net',
-        }
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.part_size,
+            multipart_chunksize=self.part_size,
+            max_concurrency=concurrency,
+        )
 
-        if credentials is not None:
-            session_params['aws_access_key_id'] = credentials['access_key']
-            session_params['aws_secret_access_key'] = credentials['secret_key']
-            session_params['region_name'] = credentials['region_name']
+    def upload(self, filename, metadata=None):
+        """
+        Uploads a file to the bucket.
+        """
+        self.s3.upload_file(filename, self.bucket, self.get_key(filename),
+                            ExtraArgs=self.get_extra_args(filename, metadata), Config=self.transfer_config)
 
-        self.s3 = session.client(**session_params)
+    def upload_fileobj(self, fileobj, filename, metadata=None):
+        """
+        Uploads a readable file-like object to the bucket.
+        """
+        self.s3.upload_fileobj(fileobj, self.bucket, self.get_key(filename),
+                               ExtraArgs=self.get_extra_args(filename, metadata), Config=self.transfer_config)
 
-    def upload(self, filename):
+    def create_upload(self, filename, metadata=None):
         """
-        Uploads a file to the bucket.
+        Returns an upload of a file written by chunks.
+        """
+        return S3Upload(self.s3, self.bucket, self.get_key(filename), self.get_extra_args(filename, metadata),
+                        self.part_size, self.concurrency)
+
+    @staticmethod
+    def get_key(filename):
+        return f'input/{os.path.basename(filename)}'
+
+    @staticmethod
+    def get_extra_args(filename, metadata=None):
+        extra_args = {'ContentType': get_content_type(filename)}
+
+        if metadata:
+            extra_args['Metadata'] = {key: str(value) for key, value in metadata.items()}
+
+        return extra_args
+
+
+class S3Upload:
+    """
+    Upload of a file written by chunks.
+    Chunks are collected into parts of a multipart upload, a file smaller than a part is put with a single request.
+    Parts are uploaded in the background, up to the concurrency at the same time, while the next ones are written.
+    """
+    # Minimum part size of S3 multipart upload
+    MIN_PART_SIZE = 5 * MB
+
+    def __init__(self, s3, bucket, key, extra_args=None, part_size=MIN_PART_SIZE, concurrency=1):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = extra_args or {}
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.upload_id = None
+        self.parts = []
+        self.pending = []
+        self.buffer = bytearray()
+
+    def write(self, chunk):
+        """
+        Adds the chunk to the file, starts uploading the collected part when it is full.
+        Blocks while the concurrency number of parts is being uploaded.
+        """
+        self.buffer += chunk
+
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+
+    def complete(self):
+        """
+        Uploads the rest of the file and completes the upload.
+        """
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.extra_args)
+            self.buffer = bytearray()
+            return
+
+        if self.buffer:
+            self._upload_part()
+
+        self._wait(0)
+
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])}
+        )
+
+    def abort(self):
+        """
+        Drops the uploaded parts.
+        """
+        self.buffer = bytearray()
+
+        wait(self.pending)
+        self.pending = []
+
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args
+            )['UploadId']
+
+        self._wait(self.concurrency - 1)
+
+        number = len(self.parts) + len(self.pending) + 1
+        body = bytes(self.buffer)
+        self.buffer = bytearray()
+
+        self.pending.append(_part_executor.submit(self._put_part, number, body))
+
+    def _put_part(self, number, body):
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body
+        )
+
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def _wait(self, limit):
+        """
+        Waits until no more than limit parts are being uploaded, raises the error of a failed part.
         """
-        self.s3.upload_file(filename, self.bucket, f'input/{os.path.basename(filename)}')
+        while len(self.pending) > limit:
+            future = self.pending.pop(0)
+            self.parts.append(future.result())
@@ -4,5 +4,13 @@ from abc import ABC, abstractmethod
 class Storage(ABC):
 
     @abstractmethod
-    def upload(self, filename):
+    def upload(self, filename, metadata=None):
+        pass
+
+    @abstractmethod
+    def upload_fileobj(self, fileobj, filename, metadata=None):
+        pass
+
+    @abstractmethod
+    def create_upload(self, filename, metadata=None):
         pass
@@ -0,0 +1,357 @@
+import asyncio
+import json
+from copy import deepcopy
+from typing import Any, Dict, Optional, Set, Tuple, cast
+
+import ydb
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._contexttypes import ContextTypes
+from telegram.ext._utils.types import BD, CD, UD, CDCData, ConversationDict, ConversationKey
+
+from ..database.yandex_database import get_session_pool
+from .executor import run_blocking
+from .persistence_codec import PersistenceCodec
+
+# Row of the persistence table: kind of the data, conversation handler name, entry key
+RowKey = Tuple[str, str, Any]
+
+
+class YdbPersistence(BasePersistence[UD, CD, BD]):
+    """
+    Persistence storing the bot data in YDB table, one row per entry:
+    user_data and chat_data per user or chat, conversation states per handler and conversation key,
+    bot_data and callback_data in a single row each.
+
+    user_data and chat_data rows are read by key on first access of the user or chat.
+    An application reused between invocations calls :meth:`reload` before processing updates,
+    so the rows changed by other instances are read again.
+    Only the changed rows are upserted, in a single transaction, right away or on :meth:`flush`
+    if ``on_flush`` is set. Ended conversations and dropped entries are deleted.
+
+    Table schema (see YandexDatabase.create_tables):
+        kind Utf8, name Utf8, entry_key Utf8, data String, PRIMARY KEY (kind, name, entry_key)
+    """
+    PAGE_SIZE = 1000
+
+    def __init__(
+            self,
+            connection_params: dict,
+            table_name: str = 'persistence',
+            store_data: Optional[PersistenceInput] = None,
+            on_flush: bool = False,
+            update_interval: float = 60,
+            context_types: Optional[ContextTypes[Any, UD, CD, BD]] = None,
+            codec: Optional[PersistenceCodec] = None,
+    ):
+        """
+        Initializes the YDB persistence.
+        :param connection_params: Connection parameters dictionary: {endpoint=, database=, credentials=}
+        :param table_name
+        """
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.table_name = table_name
+        self.on_flush = on_flush
+        self.codec = codec or PersistenceCodec()
+        self.context_types: ContextTypes[Any, UD, CD, BD] = cast(
+            ContextTypes[Any, UD, CD, BD], context_types or ContextTypes()
+        )
+        self.user_data: Dict[int, UD] = {}
+        self.chat_data: Dict[int, CD] = {}
+        self.bot_data: Optional[BD] = None
+        self.callback_data: Optional[CDCData] = None
+        self.conversations: Dict[str, Dict[ConversationKey, object]] = {}
+        self._loaded_user_ids: Set[int] = set()
+        self._loaded_chat_ids: Set[int] = set()
+        self._loaded_bot_data = False
+        self._changed: Set[RowKey] = set()
+        self._save_lock = asyncio.Lock()
+
+        self.pool = get_session_pool(connection_params)
+
+    def _execute(self, query: str, parameters: dict):
+        def callee(session):
+            prepared = session.prepare(query)
+            return session.transaction(ydb.SerializableReadWrite()).execute(prepared, parameters, commit_tx=True)
+
+        return self.pool.retry_operation_sync(callee)
+
+    async def _load_row(self, kind: str, key: Any = '', name: str = '') -> Any:
+        query = f"""
+            DECLARE $kind AS Utf8;
+            DECLARE $name AS Utf8;
+            DECLARE $entry_key AS Utf8;
+            SELECT data FROM {self.table_name} WHERE kind = $kind AND name = $name AND entry_key = $entry_key;
+        """
+        result = await run_blocking(self._execute, query, {
+            '$kind': kind,
+            '$name': name,
+            '$entry_key': self._encode_key(key),
+        })
+
+        rows = result[0].rows
+
+        if not rows:
+            return None
+
+        return self.codec.decode(rows[0]['data'])
+
+    async def _load_conversations(self, name: str) -> ConversationDict:
+        query = f"""
+            DECLARE $name AS Utf8;
+            DECLARE $last_key AS Utf8;
+            DECLARE $limit AS Uint64;
+            SELECT entry_key, data FROM {self.table_name}
+            WHERE kind = 'conversations' AND name = $name AND entry_key > $last_key
+            ORDER BY entry_key LIMIT $limit;
+        """
+        conversations = {}
+        last_key = ''
+
+        while True:
+            result = await run_blocking(self._execute, query, {
+                '$name': name,
+                '$last_key': last_key,
+                '$limit': self.PAGE_SIZE,
+            })
+
+            rows = result[0].rows
+
+            for row in rows:
+                conversations[tuple(json.loads(row['entry_key']))] = self.codec.decode(row['data'])
+
+            if len(rows) < self.PAGE_SIZE:
+                return conversations
+
+            last_key = rows[-1]['entry_key']
+
+    async def _load_conversation_states(self, keys: Dict[str, Set[ConversationKey]]) -> Dict[RowKey, Any]:
+        """Returns the stored states of the given conversations by row key, missing ones are None."""
+        rows = [
+            {'kind': 'conversations', 'name': name, 'entry_key': self._encode_key(key)}
+            for name, name_keys in keys.items()
+            for key in name_keys
+        ]
+        # The join covers the whole primary key, so each row is a point lookup
+        query = f"""
+            DECLARE $keys AS List<Struct<kind: Utf8, name: Utf8, entry_key: Utf8>>;
+            SELECT t.name AS name, t.entry_key AS entry_key, t.data AS data
+            FROM AS_TABLE($keys) AS k
+            INNER JOIN {self.table_name} AS t
+            ON t.kind = k.kind AND t.name = k.name AND t.entry_key = k.entry_key;
+        """
+        result = await run_blocking(self._execute, query, {'$keys': rows})
+
+        stored = {(row['name'], row['entry_key']): row['data'] for row in result[0].rows}
+
+        return {
+            ('conversations', name, key): (
+                self.codec.decode(stored[(name, self._encode_key(key))])
+                if (name, self._encode_key(key)) in stored else None
+            )
+            for name, name_keys in keys.items()
+            for key in name_keys
+        }
+
+    @staticmethod
+    def _encode_key(key: Any) -> str:
+        if isinstance(key, tuple):
+            return json.dumps(list(key))
+
+        return str(key)
+
+    def _get_value(self, row_key: RowKey) -> Any:
+        """Returns the current value of the row or None if the row should be deleted."""
+        kind, name, key = row_key
+
+        if kind == 'user_data':
+            return self.user_data.get(key)
+        if kind == 'chat_data':
+            return self.chat_data.get(key)
+        if kind == 'conversations':
+            return self.conversations.get(name, {}).get(key)
+        if kind == 'bot_data':
+            return self.bot_data
+
+        return self.callback_data
+
+    async def _mark_changed(self, kind: str, key: Any = '', name: str = '') -> None:
+        self._changed.add((kind, name, key))
+
+        if not self.on_flush:
+            await self._save()
+
+    async def _save(self) -> None:
+        """Upserts the changed rows and deletes the dropped ones in a single transaction."""
+        async with self._save_lock:
+            if not self._changed:
+                return
+
+            changed, self._changed = self._changed, set()
+
+            rows = []
+            deleted = []
+
+            for row_key in changed:
+                kind, name, key = row_key
+                value = self._get_value(row_key)
+                key = self._encode_key(key)
+
+                if value is None:
+                    deleted.append({'kind': kind, 'name': name, 'entry_key': key})
+                else:
+                    rows.append({'kind': kind, 'name': name, 'entry_key': key, 'data': self.codec.encode(value)})
+
+            query = f"""
+                DECLARE $rows AS List<Struct<kind: Utf8, name: Utf8, entry_key: Utf8, data: String>>;
+                DECLARE $deleted AS List<Struct<kind: Utf8, name: Utf8, entry_key: Utf8>>;
+                UPSERT INTO {self.table_name} SELECT kind, name, entry_key, data FROM AS_TABLE($rows);
+                DELETE FROM {self.table_name} ON SELECT kind, name, entry_key FROM AS_TABLE($deleted);
+            """
+
+            try:
+                await run_blocking(self._execute, query, {'$rows': rows, '$deleted': deleted})
+            except Exception:
+                # Keep the rows marked as changed to save them on the next attempt
+                self._changed |= changed
+                raise
+
+    async def get_user_data(self) -> Dict[int, UD]:
+        """Returns an empty :obj:`dict`, the entries are loaded in :meth:`refresh_user_data`."""
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, CD]:
+        """Returns an empty :obj:`dict`, the entries are loaded in :meth:`refresh_chat_data`."""
+        return {}
+
+    async def get_bot_data(self) -> BD:
+        """Returns the bot_data from the table if it exists or an empty object of type"""
+        if self.bot_data is None:
+            data = await self._load_row('bot_data')
+            self.bot_data = data if data is not None else self.context_types.bot_data()
+        return self.bot_data
+
+    async def get_callback_data(self) -> Optional[CDCData]:
+        """Returns the callback data from the table if it exists or :obj:`None`."""
+        if self.callback_data is None:
+            self.callback_data = await self._load_row('callback_data')
+        return self.callback_data
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        """Returns the conversations of the given handler from the table."""
+        if name not in self.conversations:
+            self.conversations[name] = await self._load_conversations(name)
+        return self.conversations[name].copy()
+
+    async def update_conversation(
+            self, name: str, key: ConversationKey, new_state: Optional[object]
+    ) -> None:
+        """Will update the conversation state and depending on :attr:`on_flush` save the row."""
+        conversations = self.conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        await self._mark_changed('conversations', key, name)
+
+    async def update_user_data(self, user_id: int, data: UD) -> None:
+        """Will update the user_data and depending on :attr:`on_flush` save the row."""
+        if self.user_data.get(user_id) == data:
+            return
+        self.user_data[user_id] = data
+        await self._mark_changed('user_data', user_id)
+
+    async def update_chat_data(self, chat_id: int, data: CD) -> None:
+        """Will update the chat_data and depending on :attr:`on_flush` save the row."""
+        if self.chat_data.get(chat_id) == data:
+            return
+        self.chat_data[chat_id] = data
+        await self._mark_changed('chat_data', chat_id)
+
+    async def update_bot_data(self, data: BD) -> None:
+        """Will update the bot_data and depending on :attr:`on_flush` save the row."""
+        if self.bot_data == data:
+            return
+        self.bot_data = data
+        await self._mark_changed('bot_data')
+
+    async def update_callback_data(self, data: CDCData) -> None:
+        """Will update the callback_data and depending on :attr:`on_flush` save the row."""
+        if self.callback_data == data:
+            return
+        self.callback_data = data
+        await self._mark_changed('callback_data')
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        """Will delete the chat_data row of the given chat."""
+        self.chat_data.pop(chat_id, None)
+        await self._mark_changed('chat_data', chat_id)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        """Will delete the user_data row of the given user."""
+        self.user_data.pop(user_id, None)
+        await self._mark_changed('user_data', user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: UD) -> None:
+        """Loads the user_data row of the given user on first access after start or :meth:`reload`."""
+        if user_id in self._loaded_user_ids:
+            return
+        self._loaded_user_ids.add(user_id)
+        if ('user_data', '', user_id) in self._changed:
+            # Changes of this instance are newer than the stored row
+            return
+        data = await self._load_row('user_data', user_id)
+        if not data:
+            return
+        self.user_data[user_id] = data
+        cast(Dict[Any, Any], user_data).clear()
+        cast(Dict[Any, Any], user_data).update(deepcopy(data))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: CD) -> None:
+        """Loads the chat_data row of the given chat on first access after start or :meth:`reload`."""
+        if chat_id in self._loaded_chat_ids:
+            return
+        self._loaded_chat_ids.add(chat_id)
+        if ('chat_data', '', chat_id) in self._changed:
+            # Changes of this instance are newer than the stored row
+            return
+        data = await self._load_row('chat_data', chat_id)
+        if not data:
+            return
+        self.chat_data[chat_id] = data
+        cast(Dict[Any, Any], chat_data).clear()
+        cast(Dict[Any, Any], chat_data).update(deepcopy(data))
+
+    async def refresh_bot_data(self, bot_data: BD) -> None:
+        """Copies the bot_data on first access."""
+        if self._loaded_bot_data:
+            return
+        self._loaded_bot_data = True
+        if self.bot_data is bot_data:
+            self.bot_data = deepcopy(bot_data)
+
+    async def reload(self, conversation_keys: Dict[str, Set[ConversationKey]]) -> None:
+        """Prepares the persistence of an application reused by the next update(s), as other
+        instances may have changed the rows meanwhile. user_data and chat_data rows are loaded
+        again on their next access, the states of the given conversations are read with one query.
+        Changes of this instance which are not saved yet are kept. bot_data and callback_data
+        are not reloaded."""
+        self._loaded_user_ids.clear()
+        self._loaded_chat_ids.clear()
+        keys = {name: name_keys for name, name_keys in conversation_keys.items()
+                if name_keys and name in self.conversations}
+        if not keys:
+            return
+        for row_key, state in (await self._load_conversation_states(keys)).items():
+            if row_key in self._changed:
+                continue
+            _, name, key = row_key
+            if state is None:
+                self.conversations[name].pop(key, None)
+            else:
+                self.conversations[name][key] = state
+
+    async def flush(self) -> None:
+        """Will save all changed rows."""
+        await self._save()
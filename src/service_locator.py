@@ -1,3 +1,6 @@
+from .repository.cached_repository import CachedRepository
+
+
 class ServiceLocator:
     """
     Service locator class.
@@ -22,13 +25,14 @@ class ServiceLocator:
         """
         Adds a class to the locator.
         If the class has a constructor, it can also be passed in the config.
+        If the config has the cache settings, the instance is wrapped into the read-through cache.
         """
         if 'className' not in config and 'constructor' not in config:
             raise Exception("Could not register service. There is no className or constructor")
 
         class_ = config['className'] if 'className' in config else config['constructor']
 
-        self._services[code] = [class_, config.get('constructorParams', [])]
+        self._services[code] = [class_, config.get('constructorParams', []), config.get('cache')]
 
     def register_by_config(self, config):
         """
@@ -36,7 +40,8 @@ class ServiceLocator:
         {
             'service': {
                 'className': 'Service',
-                'constructorParams': [param1, param2]
+                'constructorParams': [param1, param2],
+                'cache': {'ttl': 60, 'max_size': 1024}  # optional
             },
         }
         """
@@ -63,7 +68,7 @@ class ServiceLocator:
         if code not in self._services:
             raise Exception(f"Could not find service by code {code}")
 
-        class_, args = self._services[code]
+        class_, args, cache = self._services[code]
 
         if isinstance(class_, type(lambda: None)):
             object_ = class_()
@@ -72,6 +77,9 @@ class ServiceLocator:
                 args = args()
             object_ = class_(*args)
 
+        if cache is not None:
+            object_ = CachedRepository(object_, **cache)
+
         self._instantiated[code] = object_
 
         return object_